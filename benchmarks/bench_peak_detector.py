@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.signal import argrelextrema
+
+from fixtures import analysed_readings, time_per_call
+
+import main
+
+# Micro-benchmark of the peak detection of user_sorting_function: argrelextrema or
+# 2 * order shifted comparisons followed by select_maxima, against detect_peaks with
+# the sliding window maximum
+
+
+def argrelextrema_path(context, values, coefficients):
+    positions = argrelextrema(values, comparator=np.greater, order=10)[0]
+    return main.select_maxima(context, values, positions, coefficients)
+
+
+def shifted_path(context, values, coefficients):
+    # local_maxima of a one row matrix uses the shifted comparisons
+    positions = np.nonzero(main.local_maxima(values[None]))[1]
+    return main.select_maxima(context, values, positions, coefficients)
+
+
+def detect_peaks_path(context, values, coefficients):
+    positions, _, threshold = main.detect_peaks(context, values, coefficients)
+    return positions, threshold
+
+
+PATHS = [
+    ('argrelextrema', argrelextrema_path),
+    ('shifted comparisons', shifted_path),
+    ('detect_peaks', detect_peaks_path),
+]
+
+
+def main_benchmark(repeat=5):
+    readings = analysed_readings()
+    context = main.get_axis_context(readings[0].index)
+    # the compact float32 values classify_peaks runs on
+    values = [context.compact(spectrum.values) for spectrum in readings]
+    arguments = [(context, spectrum_values, context.baseline_coefficients(spectrum_values)) for spectrum_values in values]
+
+    # every path has to keep the same maxima
+    for argument in arguments:
+        expected, _ = argrelextrema_path(*argument)
+        for _, path in PATHS[1:]:
+            assert list(path(*argument)[0]) == list(expected)
+
+    print(f'{len(readings)} readings, {repeat} repeats')
+    baseline = None
+    for name, path in PATHS:
+        seconds = time_per_call(path, arguments, repeat)
+        baseline = baseline or seconds
+        print(f'{name:<20}: {seconds * 1e6:9.1f} us per reading ({baseline / seconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+from fixtures import analysed_readings, time_per_call
+
+import main
+
+# Micro-benchmark of the maxima filtering step of user_sorting_function:
+# the old pd.concat / drop_duplicates / Series.drop loop against select_maxima
+
+
+def legacy_filter(spectrum, iloc_max_wavenumbers, p):
+    max_wavenumbers = spectrum.iloc[iloc_max_wavenumbers]
+    beginning = pd.Series([spectrum.iloc[-20:].max()], index=[spectrum.iloc[-20:].idxmax()])
+    max_wavenumbers = pd.concat([max_wavenumbers, beginning]).drop_duplicates()
+
+    threshold = max_wavenumbers.values.mean() * 120 / 100
+    for index, value in max_wavenumbers.items():
+        if (
+            index > 3250 or
+            (index > 2000 and index < 2700) or
+            value < threshold or
+            (index > 1270 and value < p(index) * 2.7)
+        ):
+            max_wavenumbers.drop(index, inplace=True)
+    return max_wavenumbers, threshold
+
+
+def main_benchmark(repeat=5):
+    readings = analysed_readings()
+    context = main.get_axis_context(readings[0].index)
+
+    legacy_arguments, arguments = [], []
+    for spectrum in readings:
+        legacy_iloc_max = argrelextrema(spectrum.values, comparator=np.greater, order=10)[0]
+        p = np.poly1d(np.polyfit(spectrum.keys().values[:-30], spectrum.values[:-30], 5))
+        legacy_arguments.append((spectrum, legacy_iloc_max, p))
+
+        # select_maxima runs on the compact float32 values like classify_peaks
+        values = context.compact(spectrum.values)
+        iloc_max = argrelextrema(values, comparator=np.greater, order=10)[0]
+        coefficients = context.baseline_coefficients(values)
+        arguments.append((context, values, iloc_max, coefficients))
+
+        # both have to keep the same maxima
+        legacy_maxima, _ = legacy_filter(spectrum, legacy_iloc_max, p)
+        positions, _ = main.select_maxima(context, values, iloc_max, coefficients)
+        assert list(legacy_maxima.index) == list(spectrum.index[positions])
+
+    legacy = time_per_call(legacy_filter, legacy_arguments, repeat)
+    current = time_per_call(main.select_maxima, arguments, repeat)
+
+    print(f'{len(readings)} readings, {repeat} repeats')
+    print(f'Series.drop loop : {legacy * 1e6:9.1f} us per container')
+    print(f'select_maxima    : {current * 1e6:9.1f} us per container')
+    print(f'speedup          : {legacy / current:9.1f}x')
+
+
+if __name__ == '__main__':
+    main_benchmark()
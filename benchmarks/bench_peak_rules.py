@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+from fixtures import analysed_readings, time_per_call
+
+import main
+from main import Plastic
+
+# Reference check and micro-benchmark of the peak rules: the old check_* loops of
+# user_sorting_function and their if / elif chain against PeakRules, on the maxima
+# classify_peaks keeps for noisy library readings. Every rule path has to make the
+# same decisions as the loops: match (the check_* functions of main.py),
+# classify_at (one reading) and matches_batch (many readings at once).
+
+
+def legacy_PP(maxima):
+    p1, p2, p3 = False, False, 0
+    for index, value in maxima.items():
+        if (index > 1340 and index < 1400):
+            if (value < 0.25 and value > 0.05): p1 = True
+        if (index > 1420 and index < 1480):
+            if (value < 0.2 and value > 0.05): p2 = True
+        if (index > 2800 and index < 3000):
+            if (value < 0.3 and value > 0.08): p3 += 1
+
+    return p1 and p2 and (p3 >= 2)
+
+
+def legacy_PS(maxima):
+    p1, p2, p3, p4, p5 = 0, 0, 0, 0, 0
+    for index, value in maxima.items():
+        if (index > 1430 and index < 1470): p1 = 1
+        if (index > 1470 and index < 1510): p2 = 1
+        if (index > 1580 and index < 1620): p3 = 1
+        if (index > 2900 and index < 2940): p4 = 1
+        if (index > 3000 and index < 3050): p5 = 1
+
+    return p1 + p2 + p3 + p4 + p5 >= 4
+
+
+def legacy_PC(maxima):
+    p1, p2, p3 = False, False, False
+    for index, value in maxima.items():
+        if (value > 0.08 and value < 0.5):
+            if (index > 1240 and index < 1260): p1 = True
+            if (index > 1480 and index < 1520): p2 = True
+            if (index > 1750 and index < 1790): p3 = True
+
+    return p1 and p2 and p3
+
+
+def legacy_PU(maxima):
+    p1, p2, p3, p4 = False, False, False, False
+    for index, value in maxima.items():
+        if (value > 0.08 and value < 0.6):
+            if (index > 1240 and index < 1280): p1 = True
+            if (index > 1520 and index < 1550): p2 = True
+            if (index > 1700 and index < 1750): p3 = True
+        if (index > 2800 and index < 3000): p4 = True
+
+    return p1 and p2 and p3 and p4
+
+
+def legacy_HDPE(maxima):
+    p1, p2 = False, False
+    for index, value in maxima.items():
+        if (index > 1450 and index < 1480):
+            p1 = True
+        if (index > 2850 and index < 2950):
+            if (value > 0.45): p2 = True
+
+    return p1 and p2
+
+
+def legacy_LDPE(maxima):
+    for index, value in maxima.items():
+        if (index > 2850 and index < 2950):
+            if (value < 0.45 and value > 0.22):
+                return True
+
+    return False
+
+
+def legacy_PET(maxima):
+    p1, p2 = False, False
+    for index, value in maxima.items():
+        if (index > 1230 and index < 1270):
+            if (value > 0.05): p1 = True
+        if (index > 1700 and index < 1740):
+            if (value > 0.05): p2 = True
+
+    return p1 and p2
+
+
+def legacy_Polyester(maxima):
+    p1, p2 = False, False
+    for index, value in maxima.items():
+        if (value > 0.1):
+            if (index > 1690 and index < 1740): p1 = True
+        if (index > 2700 and index < 3000): p2 = True
+
+    return p1 and p2
+
+
+def legacy_PVC(maxima):
+    match = 0
+    ind2, ind3, ind4 = 0, 0, 0
+    for index, value in maxima.items():
+        if (index > 1350 and index <= 1500):
+            if (value > ind2):
+                ind2 = value
+        if (index > 1500 and index <= 2000):
+            if (value > ind3):
+                ind3 = value
+        if (index > 2850 and index <= 3000):
+            if (value > ind4):
+                ind4 = value
+
+    if (ind2 > ind3 and ind2 > ind4):
+        if(ind2 <= 0.1):
+            match = 1
+
+    return match
+
+
+# The order of the old if / elif chain, HDPE when nothing matches
+LEGACY_CHECKS = [
+    (Plastic.PS, legacy_PS, main.check_PS),
+    (Plastic.PP, legacy_PP, main.check_PP),
+    (Plastic.PU, legacy_PU, main.check_PU),
+    (Plastic.Polyester, legacy_Polyester, main.check_Polyester),
+    (Plastic.PVC, legacy_PVC, main.check_PVC),
+    (Plastic.PET, legacy_PET, main.check_PET),
+    (Plastic.HDPE, legacy_HDPE, main.check_HDPE),
+    (Plastic.LDPE, legacy_LDPE, main.check_LDPE),
+    (Plastic.PC, legacy_PC, main.check_PC),
+]
+
+
+def legacy_classify(maxima):
+    for plastic, check, _ in LEGACY_CHECKS:
+        if check(maxima):
+            return plastic
+    return Plastic.HDPE
+
+
+def main_benchmark(repeat=5):
+    readings = analysed_readings()
+    context = main.get_axis_context(readings[0].index)
+    rules = main.PEAK_RULES
+    assert rules.order == [plastic for plastic, _, _ in LEGACY_CHECKS]
+
+    legacy_arguments, arguments, rows, wavenumbers, values = [], [], [], [], []
+    for row, spectrum in enumerate(readings):
+        compact = context.compact(spectrum.values)
+        positions, heights, _ = main.detect_peaks(context, compact, context.baseline_coefficients(compact))
+        maxima = pd.Series(heights.astype(float), index=context.wavenumbers[positions])
+        legacy_arguments.append((maxima,))
+        arguments.append((context, positions, heights))
+        rows += [row] * len(positions)
+        wavenumbers.append(context.wavenumbers[positions])
+        values.append(heights)
+
+        # every check and the chain have to make the same decisions
+        for plastic, legacy_check, check in LEGACY_CHECKS:
+            assert bool(legacy_check(maxima)) == bool(check(maxima)), (row, plastic)
+        assert legacy_classify(maxima) == rules.classify_at(context, positions, heights), row
+
+    matched = rules.matches_batch(np.array(rows, dtype=int), np.concatenate(wavenumbers), np.concatenate(values), len(readings))
+    legacy_matched = [[bool(check(maxima)) for _, check, _ in LEGACY_CHECKS] for maxima, in legacy_arguments]
+    assert matched.tolist() == legacy_matched
+
+    legacy = time_per_call(legacy_classify, legacy_arguments, repeat)
+    current = time_per_call(rules.classify_at, arguments, repeat)
+
+    print(f'{len(readings)} readings, {repeat} repeats, every decision identical')
+    print(f'check_* chain    : {legacy * 1e6:9.1f} us per container')
+    print(f'classify_at      : {current * 1e6:9.1f} us per container')
+    print(f'speedup          : {legacy / current:9.1f}x')
+
+
+if __name__ == '__main__':
+    main_benchmark()
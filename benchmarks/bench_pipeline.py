@@ -0,0 +1,173 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+from fixtures import ROOT, load_corpus
+
+import main
+from main import SpectrumType
+
+# Latency benchmark of the sorting pipeline on the recorded FTIR corpus.
+# Every stage of user_sorting_function and every check_* helper is timed per call;
+# results are appended to benchmarks/results.jsonl so commits can be compared.
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+CHECKS = ['PS', 'PP', 'PU', 'Polyester', 'PVC', 'PET', 'HDPE', 'LDPE', 'PC']
+
+
+def build_stages(spectra):
+    # (stage name, function, list of argument tuples), the arguments of every stage
+    # are prepared beforehand so only the stage itself is measured
+    context = main.get_axis_context(spectra[0].index)
+    analysed = [spectrum for spectrum in spectra if not main.is_blank(spectrum.values)]
+    # the peak analysis runs on the compact float32 values like classify_peaks
+    maxima, series = [], []
+    for spectrum in analysed:
+        values = context.compact(spectrum.values)
+        iloc_max = find_local_maxima(values)
+        coefficients = context.baseline_coefficients(values)
+        positions, _ = main.select_maxima(context, values, iloc_max, coefficients)
+        maxima.append((values, iloc_max, coefficients, positions))
+        series.append(spectrum.iloc[positions])
+
+    stages = [
+        ('user_sorting_function', main.user_sorting_function, [({1: {'type': SpectrumType.FTIR, 'location': 0, 'spectrum': spectrum}},) for spectrum in spectra]),
+        ('blank_check', main.is_blank, [(spectrum.values,) for spectrum in spectra]),
+        ('baseline_fit', context.baseline_coefficients, [(values,) for values, _, _, _ in maxima]),
+        ('local_maxima', find_local_maxima, [(values,) for values, _, _, _ in maxima]),
+        ('select_maxima', main.select_maxima, [(context, values, iloc_max, coefficients) for values, iloc_max, coefficients, _ in maxima]),
+        ('detect_peaks', main.detect_peaks, [(context, values, coefficients) for values, _, coefficients, _ in maxima]),
+        ('peak_rules', classify_maxima, [(context, values, positions) for values, _, _, positions in maxima]),
+    ]
+    for name in CHECKS:
+        stages.append((f'check_{name}', getattr(main, f'check_{name}'), [(series_maxima,) for series_maxima in series]))
+    return stages
+
+
+def find_local_maxima(values):
+    return np.flatnonzero(main.local_maxima(values))
+
+
+def classify_maxima(context, values, positions):
+    return main.PEAK_RULES.classify_at(context, positions, values[positions])
+
+
+def measure(function, arguments, repeat):
+    # Per call latencies in seconds and the peak traced memory of one pass in bytes
+    latencies = np.empty(repeat * len(arguments))
+    gc.disable()
+    try:
+        i = 0
+        for _ in range(repeat):
+            for argument in arguments:
+                start = time.perf_counter()
+                function(*argument)
+                latencies[i] = time.perf_counter() - start
+                i += 1
+    finally:
+        gc.enable()
+
+    # separate pass, tracing slows every allocation down
+    tracemalloc.start()
+    for argument in arguments:
+        function(*argument)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return latencies, peak_memory
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat):
+    labels, spectra = load_corpus()
+    # warm up the axis context and the rule windows
+    main.classify_spectrum(spectra[-1])
+
+    stages = {}
+    for name, function, arguments in build_stages(spectra):
+        latencies, peak_memory = measure(function, arguments, repeat)
+        stages[name] = {
+            'calls': len(latencies),
+            'p50_us': float(np.percentile(latencies, 50) * 1e6),
+            'p99_us': float(np.percentile(latencies, 99) * 1e6),
+            'per_second': float(len(latencies) / latencies.sum()),
+            'peak_memory_kb': peak_memory / 1024,
+        }
+
+    start = time.perf_counter()
+    main.classify_batch(spectra[0].index, np.array([spectrum.values for spectrum in spectra]))
+    batch_per_second = len(spectra) / (time.perf_counter() - start)
+
+    return {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'corpus': {'spectra': len(spectra), 'classes': sorted({label.value for label in labels})},
+        'repeat': repeat,
+        'stages': stages,
+        'classify_batch_per_second': batch_per_second,
+    }
+
+
+def print_result(result, baseline=None):
+    print(f"commit {result['commit']}, {result['corpus']['spectra']} spectra x {result['repeat']} repeats")
+    header = f"{'stage':<24}{'p50 us':>10}{'p99 us':>10}{'calls/s':>12}{'peak KB':>10}"
+    if baseline is not None:
+        header += f"{'p50 vs ' + str(baseline['commit']):>20}"
+    print(header)
+    for name, stage in result['stages'].items():
+        line = f"{name:<24}{stage['p50_us']:>10.1f}{stage['p99_us']:>10.1f}{stage['per_second']:>12.0f}{stage['peak_memory_kb']:>10.1f}"
+        if baseline is not None and name in baseline['stages']:
+            change = stage['p50_us'] / baseline['stages'][name]['p50_us'] - 1
+            line += f'{change:>+19.1%}'
+        print(line)
+    print(f"classify_batch: {result['classify_batch_per_second']:.0f} spectra/s")
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Latency benchmark of the sorting pipeline')
+    parser.add_argument('--repeat', type=int, default=5, help='passes over the corpus per stage')
+    parser.add_argument('--results', default=RESULTS_FILE, help='JSON lines file the result is appended to')
+    parser.add_argument('--compare', nargs='?', const='last', help="compare with a stored commit ('last' by default)")
+    parser.add_argument('--no-save', action='store_true', help='do not store the result')
+    args = parser.parse_args()
+
+    previous = load_results(args.results)
+    result = run(args.repeat)
+
+    baseline = None
+    if args.compare and previous:
+        if args.compare == 'last':
+            baseline = previous[-1]
+        else:
+            matching = [stored for stored in previous if stored['commit'] == args.compare]
+            baseline = matching[-1] if matching else None
+            if baseline is None:
+                print(f'No stored result for commit {args.compare}')
+    print_result(result, baseline)
+
+    if not args.no_save:
+        with open(args.results, 'a') as results:
+            results.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main_benchmark()
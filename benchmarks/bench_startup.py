@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Start-up benchmark: the time to import main.py in a fresh interpreter, like a
+# headless run on a sorting line. Fails when a module that is only needed for plots
+# or by the old peak finder is imported, or when the median is over --budget.
+
+HEAVY_MODULES = ['matplotlib', 'scipy']
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted({name.split('.')[0] for name in sys.modules})}))
+'''
+
+
+def measure(repeat, cache_directory=None):
+    environment = dict(os.environ)
+    if cache_directory is not None:
+        environment['RCPLANT_LIBRARY_CACHE'] = cache_directory
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=environment, capture_output=True, text=True, check=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return np.array([run['seconds'] for run in runs]), runs[-1]['modules']
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Import time of main.py in a fresh interpreter')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cold', action='store_true', help='also time a first start with an empty library cache')
+    parser.add_argument('--budget', type=float, default=None, help='fail when the median import takes longer (seconds)')
+    args = parser.parse_args()
+
+    if args.cold:
+        with tempfile.TemporaryDirectory() as cache_directory:
+            seconds, _ = measure(1, cache_directory)
+        print(f'cold start (library cache built): {seconds[0]:.3f} s')
+
+    seconds, modules = measure(args.repeat)
+    print(f'import main: median {np.median(seconds):.3f} s, min {seconds.min():.3f} s over {args.repeat} runs')
+
+    failed = False
+    heavy = [module for module in HEAVY_MODULES if module in modules]
+    if heavy:
+        print(f'imported at start-up: {heavy}')
+        failed = True
+    if args.budget is not None and np.median(seconds) > args.budget:
+        print(f'over the budget of {args.budget:.3f} s')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+# Run from anywhere: the benchmarks import main.py from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import main
+import spectra_corpus
+from spectra_corpus import sensor_readings
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ftir_corpus.npz')
+
+
+def load_corpus(path=CORPUS_FILE, readings_per_spectrum=5, sampling_frequency=10, seed=0):
+    # The fixed benchmark corpus: noisy readings of every library spectrum, Blank
+    # included, recorded once so every commit is measured on the same spectra
+    return spectra_corpus.load_corpus(path, readings_per_spectrum, sampling_frequency, seed)
+
+
+def analysed_readings(readings_per_spectrum=3):
+    # Noisy library readings that are not blank, the ones the peak analysis runs on
+    readings = [spectrum for _, spectrum in sensor_readings(readings_per_spectrum=readings_per_spectrum)]
+    return [spectrum for spectrum in readings if not main.is_blank(spectrum.values)]
+
+
+def time_per_call(function, arguments, repeat):
+    # Mean seconds per call of function over every argument tuple, repeat times
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for argument in arguments:
+            function(*argument)
+    return (time.perf_counter() - start) / (repeat * len(arguments))
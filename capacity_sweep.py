@@ -0,0 +1,162 @@
+import argparse
+import functools
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from sharded_simulation import load_sorting_function
+from stage_metrics import StageMetrics
+
+# Capacity planning: runs the simulation of main.py over a grid of conveyor speeds,
+# sensors sampling frequencies and sensing zone placements, one grid point per
+# process, and finds the highest throughput a sorting function sustains.
+# A point is sustainable when at most max_missed of its containers reach the end of
+# the conveyor and 99% of the sorting function calls finish within the sampling
+# period. The sweep runs on the virtual clock, so a slow sorting function only shows
+# up in the latency, on a real line it would fall behind the sensors.
+
+
+def parse_placement(text):
+    # '500' or '250,750': the sensing zone locations of one placement in cm
+    return [int(location) for location in text.split(',')]
+
+
+def timed_sort(sorting_function, metrics, sensors_output):
+    with metrics.stage('tick'):
+        return sorting_function(sensors_output)
+
+
+def run_point(point, num_containers, seed, sorting_function, simulation_mode):
+    conveyor_speed, sensors_sampling_frequency, sensing_zone_locations = point
+    metrics = StageMetrics(tick_budget=1 / sensors_sampling_frequency)
+    simulator = main.create_simulator(
+        num_containers,
+        functools.partial(timed_sort, load_sorting_function(sorting_function), metrics),
+        conveyor_speed=conveyor_speed,
+        sensing_zone_locations=sensing_zone_locations,
+        sensors_sampling_frequency=sensors_sampling_frequency,
+        simulation_mode=simulation_mode,
+    )
+    # The throughput is the rate containers are put on the belt, up to the last one
+    fed = []
+
+    def on_tick(simulator):
+        if not fed and simulator._recycling_plant._num_remaining_containers == 0:
+            fed.append(simulator._current_iteration / simulator._simulation_frequency_hz)
+
+    start = time.perf_counter()
+    simulated_seconds = main.run_simulator(simulator, seed, on_tick=on_tick)
+    wall_seconds = time.perf_counter() - start
+    main.shutdown_sensor_pool()
+
+    feed_seconds = fed[0] if fed else simulated_seconds
+    tick = metrics.summary()['stages']['tick']
+    return {
+        'conveyor_speed': conveyor_speed,
+        'sensors_sampling_frequency': sensors_sampling_frequency,
+        'sensing_zone_locations': sensing_zone_locations,
+        'num_containers': num_containers,
+        'total_missed': simulator.total_missed,
+        'total_classified': simulator.total_classified,
+        'total_mistyped': simulator.total_mistyped,
+        'containers_per_minute': 60 * num_containers / feed_seconds,
+        'simulated_seconds': simulated_seconds,
+        'wall_seconds': wall_seconds,
+        'latency_mean_ms': tick['mean_us'] / 1e3,
+        'latency_p99_ms': tick['p99_us'] / 1e3,
+        'latency_max_ms': tick['max_us'] / 1e3,
+        'latency_budget_ms': 1e3 / sensors_sampling_frequency,
+    }
+
+
+def is_sustainable(result, max_missed=0.0):
+    return (result['total_missed'] <= max_missed * result['num_containers'] and
+            result['latency_p99_ms'] <= result['latency_budget_ms'])
+
+
+def run_sweep(
+        conveyor_speeds,
+        sampling_frequencies,
+        placements,
+        num_containers=100,
+        seed=0,
+        sorting_function='main:user_sorting_function',
+        simulation_mode='testing',
+        workers=None):
+    # One result per grid point in grid order, every point with the same containers
+    points = list(itertools.product(conveyor_speeds, sampling_frequencies, placements))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [
+            pool.submit(run_point, point, num_containers, seed, sorting_function, simulation_mode)
+            for point in points
+        ]
+        return [future.result() for future in futures]
+
+
+def max_sustainable(results, max_missed=0.0):
+    # The sustainable result with the highest throughput, None when there is none
+    sustainable = [result for result in results if is_sustainable(result, max_missed)]
+    return max(sustainable, key=lambda result: result['containers_per_minute'], default=None)
+
+
+def format_results(results, max_missed=0.0):
+    lines = [f"{'speed':>6}{'Hz':>4}  {'locations':<12}{'per min':>9}{'missed':>8}{'mistyped':>10}"
+             f"{'accuracy':>10}{'p99 ms':>9}{'budget':>8}  sustainable"]
+    for result in sorted(results, key=lambda result: result['containers_per_minute']):
+        decided = result['total_classified'] + result['total_mistyped']
+        accuracy = result['total_classified'] / decided if decided else 0.0
+        locations = ','.join(str(location) for location in result['sensing_zone_locations'])
+        lines.append(f"{result['conveyor_speed']:>6}{result['sensors_sampling_frequency']:>4}  {locations:<12}"
+                     f"{result['containers_per_minute']:>9.1f}{result['total_missed']:>8}{result['total_mistyped']:>10}"
+                     f"{accuracy:>10.1%}{result['latency_p99_ms']:>9.2f}{result['latency_budget_ms']:>8.0f}  "
+                     f"{'yes' if is_sustainable(result, max_missed) else 'no'}")
+    return '\n'.join(lines)
+
+
+def main_sweep():
+    parser = argparse.ArgumentParser(description='Highest sustainable throughput over a grid of line parameters')
+    parser.add_argument('--speeds', type=int, nargs='+', default=[10, 15, 20, 30, 40, 50], help='conveyor speeds in cm per second')
+    parser.add_argument('--frequencies', type=int, nargs='+', default=[10, 5], help='sensors sampling frequencies in Hz')
+    parser.add_argument('--placements', type=parse_placement, nargs='+', default=[[500]],
+                        help="sensing zone locations in cm, one placement per argument, e.g. 500 250,750")
+    parser.add_argument('--containers', type=int, default=100, help='containers per grid point')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sorting-function', default='main:user_sorting_function', help='module:function')
+    parser.add_argument('--mode', default='testing', choices=['testing', 'training'])
+    parser.add_argument('--max-missed', type=float, default=0.0, help='fraction of missed containers still sustainable')
+    parser.add_argument('--workers', type=int, default=None, help='default: one per CPU core')
+    parser.add_argument('--output', default=None, help='also write every result there as JSON')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = run_sweep(
+        args.speeds,
+        args.frequencies,
+        args.placements,
+        num_containers=args.containers,
+        seed=args.seed,
+        sorting_function=args.sorting_function,
+        simulation_mode=args.mode,
+        workers=args.workers,
+    )
+    print(f'{len(results)} grid points with {args.containers} containers each in {time.perf_counter() - start:.1f} seconds\n')
+    print(format_results(results, args.max_missed))
+
+    best = max_sustainable(results, args.max_missed)
+    if best is None:
+        print('\nNo grid point is sustainable')
+    else:
+        print(f"\nMaximum sustainable throughput: {best['containers_per_minute']:.1f} containers per minute at "
+              f"{best['conveyor_speed']} cm per second, {best['sensors_sampling_frequency']} Hz, "
+              f"sensing zones at {best['sensing_zone_locations']} cm")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'max_missed': args.max_missed, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main_sweep()
@@ -0,0 +1,221 @@
+import argparse
+import functools
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import library_cache
+
+with library_cache.cached_excel():
+    from rcplant import Plastic, SpectrumType
+
+# Record and replay of the sensors_output streams given to a sorting function.
+# A capture is a directory of append-only columns:
+#   wavenumbers.npy  the wavenumber axis, written once
+#   spectra.f32      the intensities, one packed float32 row per reading
+#   records.bin      one fixed size record per reading (see RECORD_DTYPE)
+#   manifest.json    axis length, label and sensor type tables, number of calls
+# The reading number is the row in both column files. The manifest is written with
+# the first reading and rewritten whenever a new label appears, before any record
+# refers to it, and every call is flushed to the column files, so a capture cut short
+# by a crash is still readable up to its last complete reading. Replays memory-map
+# the columns and hand out rows without copying them.
+
+RECORD_DTYPE = np.dtype([
+    ('frame', '<i8'),  # call of the sorting function the reading was given to
+    ('sensor_id', '<i4'),
+    ('type', '<i1'),  # position in the manifest's types
+    ('label', '<i2'),  # position in the manifest's labels, the spectrum name
+    ('location', '<f8'),
+])
+
+SPECTRUM_DTYPE = np.dtype('<f4')
+
+
+CAPTURE_FILES = ['records.bin', 'spectra.f32', 'wavenumbers.npy', 'manifest.json']
+
+
+class CaptureWriter:
+    def __init__(self, directory, overwrite=False):
+        # A capture already in directory is only replaced with overwrite=True
+        self.directory = directory
+        self.num_frames = 0
+        self._num_wavenumbers = None
+        self._labels = []
+        self._types = [spectrum_type.value for spectrum_type in SpectrumType]
+        existing = [name for name in CAPTURE_FILES if os.path.exists(os.path.join(directory, name))]
+        if existing and not overwrite:
+            raise FileExistsError(f'Capture already in {directory}: {existing},\n'
+                                  f'pass overwrite=True to replace it')
+        os.makedirs(directory, exist_ok=True)
+        for name in existing:
+            os.remove(os.path.join(directory, name))
+        self._records = open(os.path.join(directory, 'records.bin'), 'ab')
+        self._spectra = open(os.path.join(directory, 'spectra.f32'), 'ab')
+
+    def write(self, sensors_output):
+        # One call of the sorting function. In training mode the spectrum name is the
+        # plastic of the container, so the label is the ground truth there.
+        records = np.zeros(len(sensors_output), dtype=RECORD_DTYPE)
+        for record, (sensor_id, output) in zip(records, sensors_output.items()):
+            spectrum = output['spectrum']
+            if self._num_wavenumbers is None:
+                self._start(spectrum.index)
+            elif len(spectrum) != self._num_wavenumbers:
+                raise ValueError(f'Invalid spectrum length: {len(spectrum)},\n'
+                                 f'valid options: [{self._num_wavenumbers}]')
+            label = str(spectrum.name)
+            if label not in self._labels:
+                self._labels.append(label)
+                self._write_manifest()
+
+            record['frame'] = self.num_frames
+            record['sensor_id'] = sensor_id
+            record['type'] = self._types.index(output['type'].value)
+            record['label'] = self._labels.index(label)
+            record['location'] = output['location']
+            self._spectra.write(np.asarray(spectrum.values, dtype=SPECTRUM_DTYPE).tobytes())
+        self._records.write(records.tobytes())
+        self.num_frames += 1
+        self._spectra.flush()
+        self._records.flush()
+
+    def _start(self, index):
+        self._num_wavenumbers = len(index)
+        np.save(os.path.join(self.directory, 'wavenumbers.npy'), np.asarray(index))
+        self._write_manifest()
+
+    def _write_manifest(self):
+        # Replaced in one step, a reader never sees a half written manifest
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(path + '.tmp', 'w') as manifest:
+            json.dump({
+                'num_wavenumbers': self._num_wavenumbers,
+                'num_frames': self.num_frames,
+                'labels': self._labels,
+                'types': self._types,
+            }, manifest, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def flush(self):
+        self._spectra.flush()
+        self._records.flush()
+        if self._num_wavenumbers is not None:
+            self._write_manifest()
+
+    def close(self):
+        self.flush()
+        self._spectra.close()
+        self._records.close()
+
+
+def recorded_sort(writer, sorting_function, sensors_output):
+    writer.write(sensors_output)
+    return sorting_function(sensors_output)
+
+
+def recording_sorting_function(writer, sorting_function):
+    # For main.create_simulator, which wraps it into a plain function
+    return functools.partial(recorded_sort, writer, sorting_function)
+
+
+class CaptureReader:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as manifest:
+            manifest = json.load(manifest)
+        self.labels = manifest['labels']
+        self.types = [SpectrumType(spectrum_type) for spectrum_type in manifest['types']]
+        self.wavenumbers = pd.Index(np.load(os.path.join(directory, 'wavenumbers.npy')))
+
+        # complete readings only, a crashed capture may end with a partial row
+        num_wavenumbers = manifest['num_wavenumbers']
+        records_size = os.path.getsize(os.path.join(directory, 'records.bin'))
+        spectra_size = os.path.getsize(os.path.join(directory, 'spectra.f32'))
+        num_readings = min(records_size // RECORD_DTYPE.itemsize, spectra_size // (num_wavenumbers * SPECTRUM_DTYPE.itemsize))
+
+        if num_readings == 0:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+            self.spectra = np.zeros((0, num_wavenumbers), dtype=SPECTRUM_DTYPE)
+        else:
+            self.records = np.memmap(os.path.join(directory, 'records.bin'), dtype=RECORD_DTYPE, mode='r', shape=(num_readings,))
+            self.spectra = np.memmap(os.path.join(directory, 'spectra.f32'), dtype=SPECTRUM_DTYPE, mode='r', shape=(num_readings, num_wavenumbers))
+        # the manifest's count is only final after a flush, the records always count
+        self.num_frames = max(manifest['num_frames'], int(self.records['frame'][-1]) + 1 if num_readings else 0)
+
+    def __len__(self):
+        return len(self.records)
+
+    def label(self, reading):
+        return self.labels[self.records['label'][reading]]
+
+    def spectrum(self, reading):
+        # A view of the mapped row, nothing is copied
+        return pd.Series(self.spectra[reading], index=self.wavenumbers, name=self.label(reading), copy=False)
+
+    def frames(self):
+        # The sensors_output of every recorded call in order, including the calls
+        # without any reading
+        frames = self.records['frame']
+        starts = np.searchsorted(frames, np.arange(self.num_frames), side='left')
+        ends = np.searchsorted(frames, np.arange(self.num_frames), side='right')
+        for start, end in zip(starts, ends):
+            yield {
+                int(self.records['sensor_id'][reading]): {
+                    'type': self.types[self.records['type'][reading]],
+                    'location': float(self.records['location'][reading]),
+                    'spectrum': self.spectrum(reading),
+                }
+                for reading in range(start, end)
+            }
+
+
+def replay(directory, sorting_function):
+    # Feeds a capture to a sorting function as fast as it goes. Returns the list of
+    # identification outputs (one per call) and the wall seconds it took.
+    reader = CaptureReader(directory)
+    outputs = []
+    start = time.perf_counter()
+    for sensors_output in reader.frames():
+        outputs.append(sorting_function(sensors_output))
+    return outputs, time.perf_counter() - start
+
+
+def score(reader, outputs):
+    # Decisions against the recorded labels: (readings with a known plastic, correct).
+    # Only training captures have labels, testing readings are all 'unknown_plastic'.
+    plastics = {plastic.value for plastic in Plastic}
+    known = correct = 0
+    for frame, reading in zip(reader.records['frame'], range(len(reader))):
+        label = reader.label(reading)
+        if label not in plastics:
+            continue
+        known += 1
+        decision = outputs[frame].get(int(reader.records['sensor_id'][reading]))
+        correct += decision is not None and decision.value == label
+    return known, correct
+
+
+def main_replay():
+    from sharded_simulation import load_sorting_function
+
+    parser = argparse.ArgumentParser(description='Replay a recorded capture through a sorting function')
+    parser.add_argument('directory')
+    parser.add_argument('--sorting-function', default='main:user_sorting_function', help='module:function')
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.directory)
+    outputs, wall_time = replay(args.directory, load_sorting_function(args.sorting_function))
+    print(f'{reader.num_frames} calls with {len(reader)} readings replayed in {wall_time:.2f} seconds, '
+          f'{len(reader) / wall_time:.0f} readings per second')
+
+    known, correct = score(reader, outputs)
+    if known:
+        print(f'{correct} of {known} labeled readings identified correctly ({correct / known:.1%})')
+
+
+if __name__ == '__main__':
+    main_replay()
@@ -0,0 +1,165 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+# Diagnostic sinks for user_sorting_function in main.py.
+# A sink is called with (spectrum, maxima, baseline, threshold, plastic) for every
+# analysed reading and is closed once at the end of the simulation.
+
+
+def plot_analysis(ax, spectrum, maxima, baseline, threshold, plastic):
+    wavenumbers = spectrum.keys().values
+
+    # Plot all the information on the spectrum (this is just visualisation)
+    ax.plot(wavenumbers, spectrum.values)
+    ax.plot(maxima.keys().values, maxima.values, "v", color="red", label="maxima")
+    ax.plot(wavenumbers[:-20], baseline[:-20] * 2.7, color="green")
+    ax.hlines(y=threshold / 120 * 100, xmin=wavenumbers[0], xmax=wavenumbers[-1], label="mean", linestyles='-', color='black')
+    ax.hlines(y=threshold, xmin=wavenumbers[0], xmax=wavenumbers[-1], label="threshold", linestyles='-', color='yellow')
+    ax.set_title(f"{spectrum.name} -> {plastic.value}")
+    ax.legend()
+
+    for index, value in maxima.items():
+        ax.text(index, value, f"({index}, {round(value, 3)})")
+
+
+class ShowSink:
+    # Interactive window per reading, blocks until it is closed (old behaviour)
+    def __call__(self, spectrum, maxima, baseline, threshold, plastic):
+        from matplotlib import pyplot as plt
+
+        for index, value in maxima.items():
+            print(f"{index} - {value}")
+        print(plastic)
+        print()
+
+        plot_analysis(plt.gca(), spectrum, maxima, baseline, threshold, plastic)
+        plt.show()
+
+    def close(self):
+        pass
+
+
+class PngSink:
+    # Renders one PNG per reading on a background thread so the caller never waits
+    def __init__(self, directory, max_pending=256):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._count = 0
+        # readings are dropped instead of blocking the conveyor when the worker falls behind
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._dropped = 0
+        # the sensor pool may analyse several readings at once, every one needs its own number
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._render, daemon=True)
+        self._worker.start()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def __call__(self, spectrum, maxima, baseline, threshold, plastic):
+        with self._lock:
+            self._count += 1
+            try:
+                self._queue.put_nowait((self._count, spectrum, maxima, baseline, threshold, plastic))
+            except queue.Full:
+                self._dropped += 1
+
+    def _render(self):
+        # Figure without pyplot uses the Agg canvas and never touches a GUI backend
+        from matplotlib.figure import Figure
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            count, *analysis = item
+            figure = Figure(figsize=(12, 6))
+            plot_analysis(figure.subplots(), *analysis)
+            figure.savefig(os.path.join(self._directory, f"{count:06d}_{analysis[-1].value}.png"))
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+        if self._dropped:
+            print(f'Debug sink: {self._dropped} of {self._count} readings were not rendered, '
+                  f'the renderer fell behind')
+
+
+class DumpSink:
+    # Writes the raw arrays of the readings to numbered .npz chunks in a directory as
+    # they arrive, so memory stays at one chunk and a crash loses at most that chunk.
+    # load_dump reads them back as one set of arrays.
+    def __init__(self, directory, chunk_size=256):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._chunk_size = chunk_size
+        self._num_chunks = 0
+        self._wavenumbers = None
+        self._readings = []
+        # the sensor pool may analyse several readings at once
+        self._lock = threading.Lock()
+
+    def __call__(self, spectrum, maxima, baseline, threshold, plastic):
+        with self._lock:
+            if self._wavenumbers is None:
+                self._wavenumbers = spectrum.keys().values
+            self._readings.append((spectrum.values, maxima.keys().values, maxima.values, baseline, threshold, plastic.value))
+            if len(self._readings) >= self._chunk_size:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        spectra, maxima_wavenumbers, maxima_values, baselines, thresholds, plastics = zip(*self._readings)
+        np.savez_compressed(
+            os.path.join(self._directory, f'readings_{self._num_chunks:06d}.npz'),
+            wavenumbers=self._wavenumbers,
+            spectra=np.array(spectra),
+            baselines=np.array(baselines),
+            thresholds=np.array(thresholds),
+            plastics=np.array(plastics),
+            # maxima have a different length per reading
+            maxima_wavenumbers=_ragged(maxima_wavenumbers),
+            maxima_values=_ragged(maxima_values),
+        )
+        self._num_chunks += 1
+        self._readings = []
+
+    def close(self):
+        with self._lock:
+            if self._readings:
+                self._write_chunk()
+
+
+def load_dump(directory):
+    # The chunks of a DumpSink in order as one dict of arrays
+    names = sorted(name for name in os.listdir(directory) if name.startswith('readings_') and name.endswith('.npz'))
+    chunks = [np.load(os.path.join(directory, name), allow_pickle=True) for name in names]
+    if not chunks:
+        raise FileNotFoundError(f'No readings in {directory}')
+    readings = {'wavenumbers': chunks[0]['wavenumbers']}
+    for key in ('spectra', 'baselines', 'thresholds', 'plastics', 'maxima_wavenumbers', 'maxima_values'):
+        readings[key] = np.concatenate([chunk[key] for chunk in chunks])
+    return readings
+
+
+def _ragged(arrays):
+    # filled one by one, equal length arrays would otherwise be broadcast as a matrix
+    ragged = np.empty(len(arrays), dtype=object)
+    for number, array in enumerate(arrays):
+        ragged[number] = array
+    return ragged
+
+
+def create(mode, directory='debug_output'):
+    if mode == 'show':
+        return ShowSink()
+    elif mode == 'png':
+        return PngSink(directory)
+    elif mode == 'dump':
+        return DumpSink(os.path.join(directory, 'readings'))
+    else:
+        raise ValueError(f'Invalid debug mode: {mode},\n'
+                         f"valid options: ['show', 'png', 'dump']")
@@ -0,0 +1,130 @@
+from concurrent.futures import wait as wait_futures
+
+import library_cache
+
+with library_cache.cached_excel():
+    from rcplant import Plastic, SpectrumType
+    from rcplant._constants import MIN_CONTAINER_SIZE, MIN_CONTAINERS_GAP
+
+# Asynchronous sorting: the sorting function given to the simulator (step, which
+# main.create_simulator wraps into a plain function) only queues the readings and
+# returns whatever decisions are ready, the analysis runs on an executor
+# (in main.py the sensor pool). classify and is_blank come from the caller, e.g.
+# main.classify_sensor_output and main.is_blank, so the settings of the running
+# main.py apply.
+#
+# rcplant applies a decision to the container under the sensor on the tick it is
+# returned, so every decision is tied to the container it was made for. The sorting
+# function never sees container ids; a container is the run of non-blank readings of
+# a sensor that ends after end_after blank ones in a row: about 4% of the readings of
+# a container pass is_blank, the gaps between containers give at least blank_ticks
+# blank readings. A decision that is ready after its container left the sensor is
+# dropped.
+# Every step first queues the new readings, a decision that is already done is
+# returned on the tick of its reading; wait > 0 also waits that long for the ones in
+# flight. With max_lag a reading older than max_lag ticks is waited for, at most
+# timeout seconds, so it is not dropped as long as the smallest container stays
+# longer than that under the sensor (the virtual clock runs ticks back to back and
+# would otherwise outrun the analysis). A reading that is still not classified then
+# is given up: its container gets no decision and is missed, and a slow or stuck
+# analysis never holds up the simulation for longer than timeout.
+
+
+class DecisionPipeline:
+    def __init__(self, classify, is_blank, executor, max_lag=None, timeout=0.0, end_after=2, wait=0.0):
+        self._classify = classify
+        self._is_blank = is_blank
+        self._executor = executor
+        self.max_lag = max_lag
+        self.timeout = timeout
+        self.end_after = end_after
+        self.wait = wait
+        self._containers = {}  # sensor id -> number of the container under it, None when blank
+        self._blanks = {}  # sensor id -> blank readings in a row
+        self._num_containers = 0
+        self._jobs = {}  # sensor id -> (container number, tick, future)
+        self._given_up = {}  # sensor id -> number of the container its reading was given up for
+        self.tick = 0
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.waited = 0
+        self.timed_out = 0
+        self._latency_ticks = 0
+
+    def step(self, sensors_output):
+        # Queue the new readings and return the decisions that are ready, waits at most
+        # wait seconds and timeout seconds more for readings older than max_lag ticks
+        for sensor_id, output in sensors_output.items():
+            if output['type'] != SpectrumType.FTIR or self._is_blank(output['spectrum'].values):
+                self._blanks[sensor_id] = self._blanks.get(sensor_id, 0) + 1
+                if self._blanks[sensor_id] >= self.end_after:
+                    self._containers[sensor_id] = None
+                continue
+            self._blanks[sensor_id] = 0
+            if self._containers.get(sensor_id) is None:
+                self._num_containers += 1
+                self._containers[sensor_id] = self._num_containers
+            # one reading in flight per sensor, the readings that come meanwhile are not
+            # classified
+            if sensor_id not in self._jobs and self._given_up.get(sensor_id) != self._containers[sensor_id]:
+                self._jobs[sensor_id] = (self._containers[sensor_id], self.tick, self._executor.submit(self._classify, output))
+                self.submitted += 1
+
+        for sensor_id, (container, _, _) in list(self._jobs.items()):
+            # the container left, its decision is of no use any more
+            if container != self._containers.get(sensor_id):
+                del self._jobs[sensor_id]
+                self.dropped += 1
+
+        if self.wait > 0 and self._jobs:
+            wait_futures([future for _, _, future in self._jobs.values()], timeout=self.wait)
+        overdue = [
+            sensor_id for sensor_id, (_, tick, future) in self._jobs.items()
+            if not future.done() and self.max_lag is not None and self.tick - tick >= self.max_lag
+        ]
+        if overdue:
+            wait_futures([self._jobs[sensor_id][2] for sensor_id in overdue], timeout=self.timeout)
+
+        decisions = {}
+        for sensor_id, (container, tick, future) in list(self._jobs.items()):
+            if not future.done():
+                if sensor_id not in overdue:
+                    continue
+                # given up, the analysis keeps running on the executor
+                del self._jobs[sensor_id]
+                self._given_up[sensor_id] = container
+                self.timed_out += 1
+                continue
+            self.waited += sensor_id in overdue
+            del self._jobs[sensor_id]
+            plastic = future.result()
+            if plastic != Plastic.Blank:
+                decisions[sensor_id] = plastic
+                self.delivered += 1
+                self._latency_ticks += self.tick - tick
+        self.tick += 1
+        return decisions
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'waited': self.waited,
+            'timed_out': self.timed_out,
+            'in_flight': len(self._jobs),
+            'mean_latency_ticks': self._latency_ticks / self.delivered if self.delivered else 0.0,
+        }
+
+
+def max_lag_ticks(conveyor_speed, sensors_sampling_frequency):
+    # Calls of the sorting function the smallest container spends under a sensor,
+    # minus the one its decision has to be returned on
+    return max(0, int(MIN_CONTAINER_SIZE / conveyor_speed * sensors_sampling_frequency) - 1)
+
+
+def blank_ticks(conveyor_speed, sensors_sampling_frequency):
+    # Calls of the sorting function the smallest gap between two containers spends
+    # under a sensor, the blank readings in a row that end a container
+    return max(1, int(MIN_CONTAINERS_GAP / conveyor_speed * sensors_sampling_frequency))
@@ -4,11 +4,13 @@ from matplotlib import style
 
 from rcplant import *
 
-from scipy.signal import argrelextrema # pip install scipy -> https://pypi.org/project/scipy/
-import numpy as np # pip install numpy -> https://pypi.org/project/numpy/
 from matplotlib import pyplot as plt  # pip install matplotlib -> https://pypi.org/project/matplotlib/
 
-spectra_lst = []
+from spectra_stats import SpectraStatistics
+import spectra_review
+
+# Running average, spread and peak positions of every plastic
+spectra_stats = SpectraStatistics(order=10)
 
 def user_sorting_function(sensors_output):
     # random identification
@@ -19,34 +21,25 @@ def user_sorting_function(sensors_output):
     if spectrum.iloc[0] == 0:  
         decision = {sensor_id: Plastic.Blank}
     else:  
-        spectra_lst.append(sensors_output[sensor_id]['spectrum'])
-#---------------------------------------------------------------------------------------------------------
-        # Plot spectrum one by one
-        # n = 10
-        # # comparator = np.greater or np.less, stand for local maxima or minima
-        # # order = n, means how many points on each side to use for the comparison to consider
-        # # [0] at the end is to access the entire array of local extrema wavenumbers, based on the structure of return value
-        # iloc_max_wavenumbers = argrelextrema(spectrum.values, comparator=np.greater, order=n)[0]
-
-        # # Plot the spectrum
-        # spectrum.plot()
-
-        # # Plot the local maximum points
-        # spectrum.iloc[iloc_max_wavenumbers].plot(title= spectrum.name, style="v", color="red")
-        # plt.show()
-#---------------------------------------------------------------------------------------------------------
+        spectra_stats.update(sensors_output[sensor_id]['spectrum'])
        
     return decision
 
-def plot_local_extrema(spectra):
-    n = 10
-    for spectrum in spectra:
-        if spectrum.name == Plastic.PVC.value:
-            # comparator = np.greater or np.less, stand for local maxima or minima
-            # order = n, means how many points on each side to use for the comparison to consider
-            iloc_max = argrelextrema(spectrum.values, comparator=np.greater, order=10)[0]
-            spectrum.plot()
-            spectrum.iloc[iloc_max].plot(title= spectrum.name,style="v", color="red")
+def plot_local_extrema(statistics, path=None):
+    # With a path every plastic is written there offscreen (see spectra_review.py)
+    if path is not None:
+        spectra_review.render_statistics(path, statistics, peak_frequency=0.5)
+        return
+
+    plastic = Plastic.PVC.value
+    if statistics.count(plastic) == 0:
+        return
+    mean = statistics.mean(plastic)
+    # wavenumbers that were a local maximum (order=10) in at least half of the spectra
+    frequency = statistics.peak_frequency(plastic)
+    common_peaks = frequency.index[frequency >= 0.5]
+    mean.plot()
+    mean.loc[common_peaks].plot(title= plastic,style="v", color="red")
     plt.show()
 
 def main():
@@ -59,6 +52,7 @@ def main():
     sensing_zone_location_1 = 500  # cm
     sensors_sampling_frequency = 1  # Hz
     simulation_mode = 'training'
+    review_file = None  # e.g. 'peaks.png' to write the plot there instead of opening a window
 
     sensors = [
         Sensor.create(SpectrumType.FTIR, sensing_zone_location_1),
@@ -82,7 +76,7 @@ def main():
     for item_id, result in simulator.identification_result.items():
         print(result)
     
-    plot_local_extrema(spectra_lst)
+    plot_local_extrema(spectra_stats, review_file)
 
 
     print(f'Total missed containers = {simulator.total_missed}')
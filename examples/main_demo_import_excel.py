@@ -5,25 +5,22 @@ import os
 import pandas as pd # pip install pandas -> https://pypi.org/project/pandas/
 import numpy as np # pip install numpy -> https://pypi.org/project/numpy/
 
-def import_excel():
-    # First need to put excel file under the same folder as main.py
-    data_file = os.path.join(os.path.dirname(__file__), 'demo_import.xlsx') 
-    # Use pandas to read the entire table
-    data_table = pd.read_excel(data_file, sheet_name=0, index_col=0)
+from reference_store import ReferenceStore
+
+# First need to put excel file under the same folder as main.py
+# It is converted once to a binary store next to it (see reference_store.py)
+reference_store = ReferenceStore(os.path.join(os.path.dirname(__file__), 'demo_import.xlsx'))
 
-    # Use .loc[] the spectra you want to retrieve
-    average_spectrum = data_table.loc['PP_AVERAGE']
+def import_excel():
+    # Use .get() for the spectra you want to retrieve, no Excel parsing per call
+    average_spectrum = reference_store.get('PP_AVERAGE')
 # OR
     # You could also import raw spectrum and calculate the average by .mean()
-    raw_spectrum = data_table.loc['PP']
+    raw_spectrum = reference_store.get('PP')
     # calculate the average value
     average_value = raw_spectrum.mean()
-    # retrieve the list of wavenumbers from raw_spectrum
-    wavenumbers_list = list(raw_spectrum.keys())
-    # then create the corresponding average value (transmittance) list
-    average_value_list = [average_value for i in range(len(wavenumbers_list))]
-    # Construct the average value list and wavenumber list into a pandas.Series 
-    average_spectrum_2 = pd.Series(data=average_value_list, index=wavenumbers_list)
+    # Construct the average value and the wavenumbers of raw_spectrum into a pandas.Series
+    average_spectrum_2 = pd.Series(data=average_value, index=raw_spectrum.keys())
     return average_spectrum_2
 
 def user_sorting_function(sensors_output):
@@ -2,8 +2,11 @@ import random
 from matplotlib import pyplot as plt
 from rcplant import *
 
-# For plot
-spectra_lst = []
+from spectra_stats import SpectraStatistics
+import spectra_review
+
+# For plot, running average and spread of every plastic instead of every spectrum
+spectra_stats = SpectraStatistics()
 
 def user_sorting_function(sensors_output):
     
@@ -12,47 +15,31 @@ def user_sorting_function(sensors_output):
         decision = {sensor_id: Plastic.Blank}
     else:
         decision = {sensor_id: random.choice(list(Plastic)[0:-1])}  # random output a plastic type. [0:-1] is to avoid outputting a blank spectrum based on class Plastic
-        spectra_lst.append(sensors_output[1]['spectrum']) # append all spectra into a list for plotting
+        spectra_stats.update(sensors_output[1]['spectrum']) # add the spectrum to the statistics of its plastic for plotting
 
     return decision
 
-def plot_spectra():
+def plot_spectra(path=None):
+    # With a path the figure is written there offscreen (see spectra_review.py)
+    if path is not None:
+        spectra_review.render_statistics(path, spectra_stats)
+        return
+
     plt.figure()
 
-    # retrieve 9 types of plastic and plot them seperately
-    for spectrum in spectra_lst: 
-        plastic = spectrum.name  # Plastic.PET.value = 'PET' based on class Plastic
-                                 # They are interchangable
-        if plastic == 'PET':
-            plt.subplot(331)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.HDPE.value:
-            plt.subplot(332)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.PVC.value:
-            plt.subplot(333)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.LDPE.value:
-            plt.subplot(334)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.PP.value:
-            plt.subplot(335)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.PS.value:
-            plt.subplot(336)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.Polyester.value:
-            plt.subplot(337)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.PC.value:
-            plt.subplot(338)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        elif plastic == Plastic.PU.value:
-            plt.subplot(339)
-            spectrum.plot(title= plastic, xlabel='Wavenumber', ylabel='Transmittance')
-        else:
-            pass
-            #spectrum.plot(title= 'Blank in testing 5Hz', xlabel='Wavenumber', ylabel='Transmittance')
+    # retrieve 9 types of plastic and plot their average spectrum seperately
+    # Plastic.PET.value = 'PET' based on class Plastic, they are interchangable
+    subplots = ['PET', Plastic.HDPE.value, Plastic.PVC.value,
+                Plastic.LDPE.value, Plastic.PP.value, Plastic.PS.value,
+                Plastic.Polyester.value, Plastic.PC.value, Plastic.PU.value]
+    for number, plastic in enumerate(subplots):
+        if spectra_stats.count(plastic) == 0:
+            continue
+        plt.subplot(331 + number)
+        mean = spectra_stats.mean(plastic)
+        std = spectra_stats.std(plastic)
+        mean.plot(title=f'{plastic} ({spectra_stats.count(plastic)})', xlabel='Wavenumber', ylabel='Transmittance')
+        plt.fill_between(mean.index, mean - std, mean + std, alpha=0.3)  # one standard deviation
     plt.show()
     
 
@@ -66,6 +53,8 @@ def main():
     sensing_zone_location_1 = 500  # cm
     sensors_sampling_frequency = 1  # Hz
     simulation_mode = 'training'
+    review_file = None  # e.g. 'spectra.png' to write the plot there instead of opening a window
+    stats_file = None  # e.g. 'spectra_stats.npz', SpectraStatistics.load(stats_file) plots it later
 
     sensors = [
         Sensor.create(SpectrumType.FTIR, sensing_zone_location_1),
@@ -95,7 +84,9 @@ def main():
 
     print(f'\n{num_containers} containers are processed in {elapsed_time:.2f} seconds')
     
-    plot_spectra()
+    if stats_file is not None:
+        spectra_stats.snapshot(stats_file)
+    plot_spectra(review_file)
     
 
 
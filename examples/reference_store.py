@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Reference spectra from an Excel library (one row per spectrum, wavenumbers as
+# columns, names in the first column) converted once to NumPy files next to it.
+# Spectra are then memory-mapped lazily by name, no Excel parsing per lookup.
+
+
+class ReferenceStore:
+    def __init__(self, excel_file, store_directory=None):
+        self._excel_file = excel_file
+        self._directory = store_directory or os.path.splitext(excel_file)[0] + '_store'
+        self._manifest = None
+        self._wavenumbers = None
+        self._spectra = {}
+
+    @property
+    def names(self):
+        return list(self._load_manifest()['files'])
+
+    @property
+    def wavenumbers(self):
+        self._load_manifest()
+        return self._wavenumbers
+
+    def get(self, name):
+        # Like data_table.loc[name]: a pandas.Series when the name has one spectrum,
+        # a DataFrame with one row per spectrum otherwise
+        if name not in self._spectra:
+            manifest = self._load_manifest()
+            if name not in manifest['files']:
+                raise KeyError(f'{name} is not in {self._excel_file}')
+            rows = np.load(os.path.join(self._directory, manifest['files'][name]), mmap_mode='r')
+            if len(rows) == 1:
+                self._spectra[name] = pd.Series(rows[0], index=self._wavenumbers, name=name, copy=False)
+            else:
+                self._spectra[name] = pd.DataFrame(rows, index=[name] * len(rows), columns=self._wavenumbers, copy=False)
+        return self._spectra[name]
+
+    def matrix(self, names):
+        # One (len(names), num_wavenumbers) array, the mean of names with several spectra
+        return np.array([np.asarray(self.get(name)).reshape(-1, len(self.wavenumbers)).mean(axis=0) for name in names])
+
+    def _load_manifest(self):
+        if self._manifest is None:
+            if self._is_stale():
+                self.convert()
+            with open(os.path.join(self._directory, 'manifest.json')) as manifest:
+                self._manifest = json.load(manifest)
+            self._wavenumbers = pd.Index(np.load(os.path.join(self._directory, 'wavenumbers.npy')))
+        return self._manifest
+
+    def _is_stale(self):
+        manifest_file = os.path.join(self._directory, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return True
+        if not os.path.exists(self._excel_file):
+            return False
+        return os.path.getmtime(self._excel_file) > os.path.getmtime(manifest_file)
+
+    def convert(self):
+        # The only place the Excel file is parsed
+        data_table = pd.read_excel(self._excel_file, sheet_name=0, index_col=0)
+        os.makedirs(self._directory, exist_ok=True)
+        np.save(os.path.join(self._directory, 'wavenumbers.npy'), data_table.columns.to_numpy())
+
+        files = {}
+        for number, name in enumerate(data_table.index.unique()):
+            files[str(name)] = f'spectra_{number:03d}.npy'
+            rows = data_table.loc[[name]].to_numpy(dtype=np.float64)
+            np.save(os.path.join(self._directory, files[str(name)]), rows)
+
+        # written last, a missing manifest means the conversion did not finish
+        with open(os.path.join(self._directory, 'manifest.json'), 'w') as manifest:
+            json.dump({'excel_file': os.path.basename(self._excel_file), 'files': files}, manifest, indent=2)
+        self._manifest = None
+        self._spectra = {}
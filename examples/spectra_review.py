@@ -0,0 +1,187 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+# load_readings reads the chunks of the 'dump' debug sink with debug_sinks.py from
+# the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import debug_sinks
+
+# Offscreen review figures of many spectra at once. The spectra of every plastic are
+# stacked into one matrix and reduced to the pixel columns of their subplot (the
+# minimum and maximum of the wavenumbers in every column, so narrow peaks survive).
+# A subplot is then one LineCollection, or a density image of how many spectra pass
+# through every pixel when there are more than max_lines of them. The figures are
+# matplotlib.figure.Figure objects on the Agg canvas, pyplot and GUI backends are
+# never loaded.
+
+# Subplot order of plot_spectra, labels that are not a plastic come after these
+SUBPLOTS = ['PET', 'HDPE', 'PVC', 'LDPE', 'PP', 'PS', 'Polyester', 'PC', 'PU']
+
+
+def subplot_labels(labels):
+    present = set(labels)
+    return [label for label in SUBPLOTS if label in present] + sorted(present.difference(SUBPLOTS))
+
+
+def column_starts(num_wavenumbers, columns):
+    # First wavenumber of every pixel column, at most one column per wavenumber
+    return np.unique(np.linspace(0, num_wavenumbers, min(columns, num_wavenumbers), endpoint=False).astype(int))
+
+
+def downsample(wavenumbers, spectra, columns):
+    # (column wavenumbers, minima, maxima) with a (num_spectra, num_columns) minima
+    # and maxima, the column wavenumber is the first one of the column
+    starts = column_starts(len(wavenumbers), columns)
+    spectra = np.atleast_2d(spectra)
+    return (np.asarray(wavenumbers)[starts],
+            np.minimum.reduceat(spectra, starts, axis=1),
+            np.maximum.reduceat(spectra, starts, axis=1))
+
+
+def envelope_segments(column_wavenumbers, minima, maxima):
+    # One polyline per spectrum through the minimum and the maximum of every column,
+    # (num_spectra, 2 * num_columns, 2) for a LineCollection
+    x = np.repeat(column_wavenumbers, 2)
+    y = np.empty((len(minima), 2 * minima.shape[1]))
+    y[:, 0::2] = minima
+    y[:, 1::2] = maxima
+    return np.stack([np.broadcast_to(x, y.shape), y], axis=-1)
+
+
+def density_image(minima, maxima, rows, value_range):
+    # (rows, num_columns) counts of the spectra whose column range covers every value bin
+    low, high = value_range
+    scale = (rows - 1) / (high - low) if high > low else 0.0
+    first = np.clip(((minima - low) * scale).astype(int), 0, rows - 1)
+    last = np.clip(((maxima - low) * scale).astype(int), 0, rows - 1)
+    # +1 where a spectrum enters a column's bin range and -1 after it leaves it
+    changes = np.zeros((rows + 1, minima.shape[1]), dtype=np.int64)
+    columns = np.broadcast_to(np.arange(minima.shape[1]), minima.shape)
+    np.add.at(changes, (first, columns), 1)
+    np.add.at(changes, (last + 1, columns), -1)
+    return np.cumsum(changes[:-1], axis=0)
+
+
+def draw_spectra(ax, wavenumbers, spectra, columns, max_lines=200, rows=200, peaks=None):
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import LogNorm
+
+    column_wavenumbers, minima, maxima = downsample(wavenumbers, spectra, columns)
+    if len(spectra) <= max_lines:
+        ax.add_collection(LineCollection(envelope_segments(column_wavenumbers, minima, maxima), linewidths=0.5, alpha=0.3))
+    else:
+        value_range = (minima.min(), maxima.max())
+        image = density_image(minima, maxima, rows, value_range)
+        ax.imshow(np.ma.masked_equal(image, 0), origin='lower', aspect='auto', interpolation='nearest', cmap='viridis',
+                  norm=LogNorm(vmin=1, vmax=max(image.max(), 1)),
+                  extent=(column_wavenumbers[0], column_wavenumbers[-1], *value_range))
+
+    mean = np.mean(spectra, axis=0)
+    ax.plot(wavenumbers, mean, color='black', linewidth=0.8)
+    if peaks is not None:
+        ax.plot(np.asarray(wavenumbers)[peaks], mean[peaks], 'v', color='red')
+    ax.set_xlim(wavenumbers[0], wavenumbers[-1])
+    ax.autoscale(axis='y')
+
+
+def save_empty(path, dpi, subplot_size):
+    # The figure of render_review and render_statistics when there is nothing to render
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=subplot_size, dpi=dpi)
+    figure.text(0.5, 0.5, 'No spectra', ha='center', va='center')
+    figure.savefig(path)
+
+
+def render_review(path, wavenumbers, spectra, labels, max_lines=200, peaks=None, dpi=100, subplot_size=(5, 4)):
+    # One subplot per label with all its spectra, written to path (.png, .pdf, .svg).
+    # peaks, when given, maps labels to the positions marked on the mean spectrum.
+    from matplotlib.figure import Figure
+
+    labels = np.asarray(labels)
+    plastics = subplot_labels(labels)
+    if not plastics:
+        return save_empty(path, dpi, subplot_size)
+    num_columns = min(3, len(plastics))
+    num_rows = -(-len(plastics) // num_columns)
+    figure = Figure(figsize=(subplot_size[0] * num_columns, subplot_size[1] * num_rows), dpi=dpi)
+    axes = figure.subplots(num_rows, num_columns, squeeze=False).ravel()
+
+    for ax, plastic in zip(axes, plastics):
+        selected = np.asarray(spectra[labels == plastic])
+        draw_spectra(ax, wavenumbers, selected, columns=int(subplot_size[0] * dpi),
+                     max_lines=max_lines, peaks=None if peaks is None else peaks.get(plastic))
+        ax.set_title(f'{plastic} ({len(selected)})')
+        ax.set_xlabel('Wavenumber')
+        ax.set_ylabel('Transmittance')
+    for ax in axes[len(plastics):]:
+        ax.set_visible(False)
+
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def render_statistics(path, statistics, peak_frequency=None, dpi=100, subplot_size=(5, 4)):
+    # The mean and one standard deviation of every plastic of a SpectraStatistics like
+    # plot_spectra, and the wavenumbers that were a maximum in at least peak_frequency
+    # of the spectra like plot_local_extrema, written to path
+    from matplotlib.figure import Figure
+
+    plastics = subplot_labels([plastic for plastic in statistics.plastics if statistics.count(plastic) > 0])
+    if not plastics:
+        return save_empty(path, dpi, subplot_size)
+    num_columns = min(3, len(plastics))
+    num_rows = -(-len(plastics) // num_columns)
+    figure = Figure(figsize=(subplot_size[0] * num_columns, subplot_size[1] * num_rows), dpi=dpi)
+    axes = figure.subplots(num_rows, num_columns, squeeze=False).ravel()
+
+    for ax, plastic in zip(axes, plastics):
+        mean = statistics.mean(plastic).values
+        std = statistics.std(plastic).values
+        column_wavenumbers, low, high = downsample(statistics.wavenumbers, np.array([mean - std, mean + std]), int(subplot_size[0] * dpi))
+        ax.fill_between(column_wavenumbers, low[0], high[1], alpha=0.3)
+        ax.plot(statistics.wavenumbers, mean)
+        if peak_frequency is not None:
+            peaks = statistics.peak_frequency(plastic).values >= peak_frequency
+            ax.plot(statistics.wavenumbers[peaks], mean[peaks], 'v', color='red')
+        ax.set_title(f'{plastic} ({statistics.count(plastic)})')
+        ax.set_xlabel('Wavenumber')
+        ax.set_ylabel('Transmittance')
+    for ax in axes[len(plastics):]:
+        ax.set_visible(False)
+
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def load_readings(path):
+    # (wavenumbers, spectra, labels) of a corpus .npz (spectra_corpus.py) or of the
+    # directory of chunks of the 'dump' debug sink, labelled with the decisions there
+    if os.path.isdir(path):
+        readings = debug_sinks.load_dump(path)
+        return readings['wavenumbers'], readings['spectra'], [str(label) for label in readings['plastics']]
+    readings = np.load(path)
+    return readings['wavenumbers'], readings['spectra'], [str(label) for label in readings['labels']]
+
+
+def main_review():
+    parser = argparse.ArgumentParser(description='Render all the spectra of a recording into one review figure')
+    parser.add_argument('readings', help='corpus .npz or debug_output/readings')
+    parser.add_argument('--output', default='review.png')
+    parser.add_argument('--max-lines', type=int, default=200, help='density image above this many spectra per plastic')
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args()
+
+    wavenumbers, spectra, labels = load_readings(args.readings)
+    render_review(args.output, wavenumbers, spectra, labels, max_lines=args.max_lines, dpi=args.dpi)
+    print(f'{len(labels)} spectra rendered to {args.output}')
+
+
+if __name__ == '__main__':
+    main_review()
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+# Running statistics of the spectra of every plastic, updated in place for every
+# reading so memory stays (plastics x wavenumbers) however many containers pass.
+# Mean and variance use Welford's online algorithm; for the peak positions every
+# wavenumber counts how often it was a local maximum and sums the peak heights.
+
+
+class SpectraStatistics:
+    def __init__(self, order=10):
+        self.order = order
+        self.wavenumbers = None
+        self._counts = {}
+        self._means = {}
+        self._squared_deviations = {}
+        self._peak_counts = {}
+        self._peak_heights = {}
+
+    @property
+    def plastics(self):
+        return list(self._counts)
+
+    def update(self, spectrum, plastic=None):
+        # In training mode the spectrum is named after its plastic
+        plastic = plastic or spectrum.name
+        values = np.asarray(spectrum.values, dtype=float)
+        if self.wavenumbers is None:
+            self.wavenumbers = np.asarray(spectrum.keys())
+        if plastic not in self._counts:
+            self._counts[plastic] = 0
+            self._means[plastic] = np.zeros(len(values))
+            self._squared_deviations[plastic] = np.zeros(len(values))
+            self._peak_counts[plastic] = np.zeros(len(values), dtype=np.int64)
+            self._peak_heights[plastic] = np.zeros(len(values))
+
+        self._counts[plastic] += 1
+        mean = self._means[plastic]
+        delta = values - mean
+        mean += delta / self._counts[plastic]
+        self._squared_deviations[plastic] += delta * (values - mean)
+
+        peaks = argrelextrema(values, comparator=np.greater, order=self.order)[0]
+        self._peak_counts[plastic][peaks] += 1
+        self._peak_heights[plastic][peaks] += values[peaks]
+
+    def count(self, plastic):
+        return self._counts.get(plastic, 0)
+
+    def mean(self, plastic):
+        return pd.Series(self._means[plastic], index=self.wavenumbers, name=plastic)
+
+    def variance(self, plastic):
+        count = self._counts[plastic]
+        variance = self._squared_deviations[plastic] / (count - 1) if count > 1 else np.zeros(len(self.wavenumbers))
+        return pd.Series(variance, index=self.wavenumbers, name=plastic)
+
+    def std(self, plastic):
+        return np.sqrt(self.variance(plastic))
+
+    def peak_frequency(self, plastic):
+        # Fraction of the readings with a local maximum at every wavenumber
+        return pd.Series(self._peak_counts[plastic] / self._counts[plastic], index=self.wavenumbers, name=plastic)
+
+    def peak_height(self, plastic):
+        # Average height of the maxima found at every wavenumber, 0 where there were none
+        counts = self._peak_counts[plastic]
+        heights = np.divide(self._peak_heights[plastic], counts, out=np.zeros(len(counts)), where=counts > 0)
+        return pd.Series(heights, index=self.wavenumbers, name=plastic)
+
+    def snapshot(self, path):
+        arrays = {'wavenumbers': self.wavenumbers, 'plastics': np.array(self.plastics), 'order': self.order}
+        for number, plastic in enumerate(self.plastics):
+            arrays[f'count_{number}'] = self._counts[plastic]
+            arrays[f'mean_{number}'] = self._means[plastic]
+            arrays[f'squared_deviations_{number}'] = self._squared_deviations[plastic]
+            arrays[f'peak_counts_{number}'] = self._peak_counts[plastic]
+            arrays[f'peak_heights_{number}'] = self._peak_heights[plastic]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        statistics = cls(int(data['order']))
+        statistics.wavenumbers = data['wavenumbers']
+        for number, plastic in enumerate(data['plastics']):
+            plastic = str(plastic)
+            statistics._counts[plastic] = int(data[f'count_{number}'])
+            statistics._means[plastic] = data[f'mean_{number}']
+            statistics._squared_deviations[plastic] = data[f'squared_deviations_{number}']
+            statistics._peak_counts[plastic] = data[f'peak_counts_{number}']
+            statistics._peak_heights[plastic] = data[f'peak_heights_{number}']
+        return statistics
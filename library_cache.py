@@ -0,0 +1,72 @@
+import contextlib
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+# rcplant parses its Excel spectra libraries when it is imported, which is most of
+# the start-up time of main.py (~5 s). Inside cached_excel() every table read with
+# pd.read_excel is kept as an .npz next to this file and loaded from there while the
+# Excel file is unchanged. The tables come back as single float blocks, the same
+# layout consolidate_spectra_library() gives them.
+
+CACHE_DIRECTORY = os.environ.get(
+    'RCPLANT_LIBRARY_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.library_cache'))
+
+
+def cache_file(excel_file, sheet_name, index_col):
+    status = os.stat(excel_file)
+    key = f'{os.path.abspath(excel_file)}|{status.st_size}|{status.st_mtime_ns}|{sheet_name}|{index_col}'
+    name = os.path.splitext(os.path.basename(excel_file))[0].replace(' ', '_')
+    return os.path.join(CACHE_DIRECTORY, f'{name}_{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}.npz')
+
+
+def save_table(path, table):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written under another name first so a reader never sees half a file
+    temporary = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(
+        temporary,
+        values=table.to_numpy(dtype=np.float64),
+        index=np.asarray(table.index, dtype=str),
+        index_name=np.array('' if table.index.name is None else str(table.index.name)),
+        columns=table.columns.to_numpy(),
+    )
+    os.replace(temporary, path)
+
+
+def load_table(path):
+    with np.load(path) as cached:
+        index_name = str(cached['index_name']) or None
+        return pd.DataFrame(
+            cached['values'],
+            index=pd.Index(cached['index'], name=index_name),
+            columns=pd.Index(cached['columns']),
+        )
+
+
+@contextlib.contextmanager
+def cached_excel():
+    read_excel = pd.read_excel
+
+    def read_excel_cached(io, sheet_name=0, index_col=None, **kwargs):
+        # only plain numeric tables read by path are cached
+        if kwargs or not isinstance(io, str) or not isinstance(sheet_name, (int, str)):
+            return read_excel(io, sheet_name=sheet_name, index_col=index_col, **kwargs)
+        path = cache_file(io, sheet_name, index_col)
+        if os.path.exists(path):
+            return load_table(path)
+        table = read_excel(io, sheet_name=sheet_name, index_col=index_col)
+        if all(np.issubdtype(dtype, np.floating) for dtype in table.dtypes):
+            try:
+                save_table(path, table)
+            except OSError:
+                pass  # read-only checkout, parse again next time
+        return table
+
+    pd.read_excel = read_excel_cached
+    try:
+        yield
+    finally:
+        pd.read_excel = read_excel
@@ -1,212 +1,1156 @@
-import pandas as pd
+import contextlib
+import hashlib
+import json
+import random
+import threading
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
-from rcplant import *
-from scipy.signal import argrelextrema
-from matplotlib import pyplot as plt
+import pandas as pd
+
+import library_cache
+
+# rcplant parses its spectra libraries on import, cached_excel() keeps them as .npz
+with library_cache.cached_excel():
+    from rcplant import Conveyor, Plastic, RPSimulation, Sensor, SpectrumType
+    from rcplant._constants import MIN_CONTAINER_SIZE
+    from rcplant._material import DATA_SETS
+
+# Optional diagnostics sink, off by default so the sorting function stays headless.
+# When set (see debug_sinks.py) it is called with the spectrum, the kept maxima,
+# the baseline, the threshold and the decision of every analysed reading.
+debug_sink = None
+
+# Optional per-stage timing (see stage_metrics.py), off by default. When it is None
+# every stage() is the same no-op context manager.
+metrics = None
+_untimed = contextlib.nullcontext()
+
+
+def stage(name):
+    return _untimed if metrics is None else metrics.stage(name)
+
+# Peak rules for every plastic in the order they are checked, the first match wins.
+# A band (low, high, min_value, max_value, min_peaks) matches when at least min_peaks
+# maxima have low < wavenumber < high and min_value < value < max_value.
+# A plastic matches when at least `required` of its bands match.
+BAND_RULES = {
+    Plastic.PS: (4, [
+        (1430, 1470, -np.inf, np.inf, 1),
+        (1470, 1510, -np.inf, np.inf, 1),
+        (1580, 1620, -np.inf, np.inf, 1),
+        (2900, 2940, -np.inf, np.inf, 1),
+        (3000, 3050, -np.inf, np.inf, 1),
+    ]),
+    Plastic.PP: (3, [
+        (1340, 1400, 0.05, 0.25, 1),
+        (1420, 1480, 0.05, 0.2, 1),
+        (2800, 3000, 0.08, 0.3, 2),
+    ]),
+    Plastic.PU: (4, [
+        (1240, 1280, 0.08, 0.6, 1),
+        (1520, 1550, 0.08, 0.6, 1),
+        (1700, 1750, 0.08, 0.6, 1),
+        (2800, 3000, -np.inf, np.inf, 1),
+    ]),
+    Plastic.Polyester: (2, [
+        (1690, 1740, 0.1, np.inf, 1),
+        (2700, 3000, -np.inf, np.inf, 1),
+    ]),
+    Plastic.PET: (2, [
+        (1230, 1270, 0.05, np.inf, 1),
+        (1700, 1740, 0.05, np.inf, 1),
+    ]),
+    Plastic.HDPE: (2, [
+        (1450, 1480, -np.inf, np.inf, 1),
+        (2850, 2950, 0.45, np.inf, 1),
+    ]),
+    Plastic.LDPE: (1, [
+        (2850, 2950, 0.22, 0.45, 1),
+    ]),
+    Plastic.PC: (3, [
+        (1240, 1260, 0.08, 0.5, 1),
+        (1480, 1520, 0.08, 0.5, 1),
+        (1750, 1790, 0.08, 0.5, 1),
+    ]),
+}
+
+# A dominant band rule (band, other_bands, max_value) matches when the highest maximum
+# in band (low < wavenumber <= high) is higher than the highest maximum in every other
+# band and is at most max_value. Bands without maxima count as 0.
+DOMINANT_RULES = {
+    Plastic.PVC: ((1350, 1500), [(1500, 2000), (2850, 3000)], 0.1),
+}
+
+RULE_ORDER = [
+    Plastic.PS,
+    Plastic.PP,
+    Plastic.PU,
+    Plastic.Polyester,
+    Plastic.PVC,
+    Plastic.PET,
+    Plastic.HDPE,
+    Plastic.LDPE,
+    Plastic.PC,
+]
+
+
+class PeakRules:
+    # The rule tables compiled into flat arrays so that every plastic is evaluated
+    # together in one NumPy pass over the maxima of many spectra (matches_batch), and
+    # into plain lists for the few maxima of one reading, where every NumPy call costs
+    # more than the comparisons: classify_at only walks the bands each maximum falls in
+    # and stops at the first plastic that matches, match only evaluates one plastic.
+
+    def __init__(self, band_rules, dominant_rules, order, default=Plastic.HDPE):
+        self.band_rules = band_rules
+        self.dominant_rules = dominant_rules
+        self.order = list(order)
+        self.default = default
+        # the decisions only depend on the tables, part of the decision cache keys
+        self.fingerprint = hashlib.blake2b(repr((band_rules, dominant_rules, self.order, default)).encode(), digest_size=8).digest()
+
+        bands, owners, required = [], [], np.zeros(len(self.order))
+        windows, dominant_owners, dominant_max = [], [], []
+        # per plastic in order: ('bands', band rows, required) or ('dominant', window row, other window rows, max_value)
+        self._checks = []
+        for position, plastic in enumerate(self.order):
+            if plastic in band_rules:
+                required[position], plastic_bands = band_rules[plastic]
+                self._checks.append(('bands', range(len(bands), len(bands) + len(plastic_bands)), int(required[position])))
+                bands += plastic_bands
+                owners += [position] * len(plastic_bands)
+            elif plastic in dominant_rules:
+                band, other_bands, max_value = dominant_rules[plastic]
+                self._checks.append(('dominant', len(windows), range(len(windows) + 1, len(windows) + 1 + len(other_bands)), max_value))
+                windows += [band] + other_bands
+                dominant_owners.append((position, len(other_bands)))
+                dominant_max.append(max_value)
+            else:
+                raise ValueError(f'No peak rule for {plastic}')
+        self._bands = [tuple(float(limit) for limit in band) for band in bands]
+        self._band_owners = list(owners)
+        # bands that need no maxima match whatever the reading
+        self._empty_bands_matched = [0] * len(self.order)
+        for band, owner in zip(bands, owners):
+            self._empty_bands_matched[owner] += band[4] <= 0
+        self._windows = [tuple(float(limit) for limit in window) for window in windows]
+
+        bands = np.array(bands, dtype=float).reshape(-1, 5)
+        self._low, self._high, self._min_value, self._max_value, self._min_peaks = (column[:, None] for column in bands.T)
+        self._owners = np.array(owners, dtype=int)
+        self._required = required
+
+        windows = np.array(windows, dtype=float).reshape(-1, 2)
+        self._window_low, self._window_high = windows[:, :1], windows[:, 1:]
+        self._dominant_owners = dominant_owners
+        self._dominant_max = dominant_max
+
+    def windows(self, wavenumbers):
+        # Which maxima fall in every band and every dominant rule window, an AxisContext
+        # computes this once for the whole axis
+        wavenumbers = np.asarray(wavenumbers)
+        in_bands = (wavenumbers > self._low) & (wavenumbers < self._high)
+        in_windows = (wavenumbers > self._window_low) & (wavenumbers <= self._window_high)
+        return in_bands, in_windows
+
+    def _dominant_matched(self, check, window_max):
+        _, window, others, max_value = check
+        band_max = window_max[window]
+        return band_max <= max_value and all(band_max > window_max[other] for other in others)
+
+    def match(self, plastic, maxima):
+        # Only the bands or windows of plastic are evaluated
+        check = self._checks[self.order.index(plastic)]
+        maxima = list(zip(maxima.keys().tolist(), maxima.tolist()))
+        if check[0] == 'bands':
+            _, rows, required = check
+            # stops as soon as the outcome is known
+            remaining = len(rows)
+            for row in rows:
+                low, high, min_value, max_value, min_peaks = self._bands[row]
+                hits = 0
+                for wavenumber, value in maxima:
+                    if low < wavenumber < high and min_value < value < max_value:
+                        hits += 1
+                required -= hits >= min_peaks
+                remaining -= 1
+                if required <= 0 or required > remaining:
+                    break
+            return required <= 0
+
+        window_max = {}
+        for row in (check[1], *check[2]):
+            low, high = self._windows[row]
+            band_max = 0.0
+            for wavenumber, value in maxima:
+                if low < wavenumber <= high and value > band_max:
+                    band_max = value
+            window_max[row] = band_max
+        return self._dominant_matched(check, window_max)
+
+    def classify_at(self, context, positions, heights):
+        # First plastic in order whose rules the kept maxima of a reading on an
+        # AxisContext match, the default (None when default is None) otherwise
+        bands_at, windows_at = context.rule_lists(self)
+        bands = self._bands
+        hits = [0] * len(bands)
+        bands_matched = list(self._empty_bands_matched)
+        window_max = [0.0] * len(self._windows)
+        for position, value in zip(positions.tolist(), heights.tolist()):
+            for row in bands_at[position]:
+                _, _, min_value, max_value, min_peaks = bands[row]
+                if min_value < value < max_value:
+                    hits[row] += 1
+                    if hits[row] == min_peaks:
+                        bands_matched[self._band_owners[row]] += 1
+            for row in windows_at[position]:
+                if value > window_max[row]:
+                    window_max[row] = value
+
+        plastic = self.default
+        checked = len(self._checks)
+        for position, check in enumerate(self._checks):
+            if check[0] == 'bands' and bands_matched[position] >= check[2] or \
+                    check[0] == 'dominant' and self._dominant_matched(check, window_max):
+                plastic, checked = self.order[position], position + 1
+                break
+        if metrics is not None:
+            metrics.count('rule_checks', checked)
+        return plastic
+
+    def matches_batch(self, rows, wavenumbers, values, num_rows, windows=None):
+        # Same as matches for the maxima of num_rows spectra at once, the maxima are
+        # flat arrays sorted by their spectrum row. Returns (num_rows, plastics).
+        values = np.asarray(values)
+        in_bands, in_window = self.windows(wavenumbers) if windows is None else windows
+        starts = np.searchsorted(rows, np.arange(num_rows), side='left')
+        ends = np.searchsorted(rows, np.arange(num_rows), side='right')
+
+        hits = in_bands & (values > self._min_value) & (values < self._max_value)
+        # per row hit counts from a running sum over the row sorted maxima
+        hits_sum = np.zeros((hits.shape[0], hits.shape[1] + 1))
+        np.cumsum(hits, axis=1, out=hits_sum[:, 1:])
+        bands_matched = (hits_sum[:, ends] - hits_sum[:, starts]) >= self._min_peaks
+        matched = np.zeros((len(self.order), num_rows))
+        np.add.at(matched, self._owners, bands_matched)
+        matched = (matched >= self._required[:, None]).T
+
+        if len(values) == 0:
+            window_max = np.zeros((len(self._window_low), num_rows))
+        else:
+            window_max = np.maximum.reduceat(np.where(in_window, values, 0), np.minimum(starts, len(values) - 1), axis=1)
+            window_max = np.where(ends > starts, np.maximum(window_max, 0), 0)
+        start = 0
+        for (position, num_others), max_value in zip(self._dominant_owners, self._dominant_max):
+            band_max = window_max[start]
+            others_max = window_max[start + 1:start + 1 + num_others]
+            matched[:, position] = (band_max > others_max).all(axis=0) & (band_max <= max_value)
+            start += 1 + num_others
+
+        return matched
+
+    def classify_batch(self, rows, wavenumbers, values, num_rows, windows=None):
+        matched = self.matches_batch(rows, wavenumbers, values, num_rows, windows)
+        return [self.order[row.argmax()] if row.any() else self.default for row in matched]
+
+
+PEAK_RULES = PeakRules(BAND_RULES, DOMINANT_RULES, RULE_ORDER)
+
+
+def save_peak_rules(path, rules):
+    # JSON with the plastic values as keys (infinite limits are written as Infinity)
+    with open(path, 'w') as rules_file:
+        json.dump({
+            'order': [plastic.value for plastic in rules.order],
+            'default': rules.default.value,
+            'band_rules': {
+                plastic.value: {'required': int(required), 'bands': [list(band) for band in bands]}
+                for plastic, (required, bands) in rules.band_rules.items()
+            },
+            'dominant_rules': {
+                plastic.value: {'band': list(band), 'other_bands': [list(other) for other in other_bands], 'max_value': max_value}
+                for plastic, (band, other_bands, max_value) in rules.dominant_rules.items()
+            },
+        }, rules_file, indent=2)
+
+
+def load_peak_rules(path):
+    with open(path) as rules_file:
+        rules = json.load(rules_file)
+    band_rules = {
+        Plastic(plastic): (rule['required'], [tuple(band) for band in rule['bands']])
+        for plastic, rule in rules['band_rules'].items()
+    }
+    dominant_rules = {
+        Plastic(plastic): (tuple(rule['band']), [tuple(other) for other in rule['other_bands']], rule['max_value'])
+        for plastic, rule in rules['dominant_rules'].items()
+    }
+    return PeakRules(band_rules, dominant_rules, [Plastic(plastic) for plastic in rules['order']], Plastic(rules['default']))
+
+
+# Coarse to fine classification. The band of the highest kept maximum picks a group
+# of candidate plastics, like the is_* checks of examples/main_demo_sorting.py, and
+# only the peak rules of those candidates run, in the group's order. When none of
+# them matches the group's default is used, or the flat rules when it has none; a
+# maximum outside every band also goes to the flat rules. tune_rules.py --hierarchy
+# learns the candidates, their order and the defaults from a labeled corpus.
+# (band (low < wavenumber < high), candidates, default), learned on
+# benchmarks/data/ftir_corpus.npz
+HIERARCHY_GROUPS = [
+    ((1250, 1275), [Plastic.PC, Plastic.PU, Plastic.PVC, Plastic.PET], None),
+    ((1400, 1500), [Plastic.PS], None),
+    ((2850, 2950), [Plastic.HDPE, Plastic.PP, Plastic.LDPE], None),
+    ((1700, 1800), [Plastic.PC, Plastic.PU, Plastic.Polyester, Plastic.PET], None),
+]
+
+
+def classify_rows(rules, selected, plastics, rows, wavenumbers, values):
+    # classify_batch of rules over the selected rows only, written into plastics
+    if len(selected) == 0:
+        return
+    kept = np.isin(rows, selected)
+    selected_plastics = rules.classify_batch(
+        np.searchsorted(selected, rows[kept]), wavenumbers[kept], values[kept], len(selected))
+    for row, plastic in zip(selected, selected_plastics):
+        plastics[row] = plastic
+
+
+class HierarchicalRules:
+    def __init__(self, rules, groups):
+        self.rules = rules
+        self.groups = groups
+        self.fingerprint = hashlib.blake2b(repr((rules.fingerprint, groups)).encode(), digest_size=8).digest()
+        self.group_rules = [
+            PeakRules(
+                { plastic: rules.band_rules[plastic] for plastic in candidates if plastic in rules.band_rules },
+                { plastic: rules.dominant_rules[plastic] for plastic in candidates if plastic in rules.dominant_rules },
+                candidates,
+                default,
+            )
+            for _, candidates, default in groups
+        ]
+        # rules without the candidates that already failed, for the readings of a group
+        # without default that match none of them
+        self.fallback_rules = [
+            None if default is not None else PeakRules(
+                rules.band_rules,
+                rules.dominant_rules,
+                [plastic for plastic in rules.order if plastic not in candidates],
+                rules.default,
+            )
+            for _, candidates, default in groups
+        ]
+        bands = np.array([band for band, _, _ in groups], dtype=float).reshape(-1, 2)
+        self._low, self._high = bands[:, 0], bands[:, 1]
+
+    def group(self, wavenumber):
+        # Index of the group of a dominant maximum, None outside every band
+        inside = np.flatnonzero((wavenumber > self._low) & (wavenumber < self._high))
+        return int(inside[0]) if len(inside) else None
+
+    def classify_at(self, context, positions, heights):
+        group = self.group(context.wavenumbers[positions[heights.argmax()]]) if len(heights) else None
+        if group is None:
+            return self.rules.classify_at(context, positions, heights)
+        plastic = self.group_rules[group].classify_at(context, positions, heights)
+        if plastic is None:
+            return self.fallback_rules[group].classify_at(context, positions, heights)
+        return plastic
+
+    def groups_batch(self, rows, wavenumbers, values, num_rows):
+        # Group of every row's highest maximum like group, -1 outside every band or
+        # for a row without maxima
+        values = np.asarray(values)
+        by_height = np.lexsort((-values, rows))
+        first = np.searchsorted(rows[by_height], np.arange(num_rows), side='left')
+        has_maxima = first < len(rows)
+        has_maxima[has_maxima] = rows[by_height][first[has_maxima]] == np.arange(num_rows)[has_maxima]
+        dominant = np.zeros(num_rows)
+        dominant[has_maxima] = wavenumbers[by_height][first[has_maxima]]
+        inside = (dominant[:, None] > self._low) & (dominant[:, None] < self._high) & has_maxima[:, None]
+        if len(self.groups) == 0:
+            return np.full(num_rows, -1)
+        return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+    def classify_batch(self, rows, wavenumbers, values, num_rows):
+        # Every row only runs the rules classify_at runs for it: the candidates of its
+        # group, and the rest of the flat table when none of them matches
+        values = np.asarray(values)
+        groups = self.groups_batch(rows, wavenumbers, values, num_rows)
+        plastics = [None] * num_rows
+        selected = np.flatnonzero(groups == -1)
+        classify_rows(self.rules, selected, plastics, rows, wavenumbers, values)
+        for group, group_rules in enumerate(self.group_rules):
+            selected = np.flatnonzero(groups == group)
+            classify_rows(group_rules, selected, plastics, rows, wavenumbers, values)
+            if self.fallback_rules[group] is not None:
+                unmatched = np.array([row for row in selected if plastics[row] is None], dtype=int)
+                classify_rows(self.fallback_rules[group], unmatched, plastics, rows, wavenumbers, values)
+        return plastics
+
+
+def save_hierarchy(path, hierarchical_rules):
+    with open(path, 'w') as hierarchy_file:
+        json.dump({
+            'groups': [
+                {
+                    'band': list(band),
+                    'candidates': [plastic.value for plastic in candidates],
+                    'default': None if default is None else default.value,
+                }
+                for band, candidates, default in hierarchical_rules.groups
+            ],
+        }, hierarchy_file, indent=2)
+
+
+def load_hierarchy(path, rules):
+    with open(path) as hierarchy_file:
+        groups = json.load(hierarchy_file)['groups']
+    return HierarchicalRules(rules, [
+        (
+            tuple(group['band']),
+            [Plastic(plastic) for plastic in group['candidates']],
+            None if group['default'] is None else Plastic(group['default']),
+        )
+        for group in groups
+    ])
+
+
+# The HierarchicalRules of classification_mode 'hierarchy', built from PEAK_RULES
+# and HIERARCHY_GROUPS on first use when it is not set
+hierarchy = None
+
+
+def get_hierarchy():
+    global hierarchy
+    if hierarchy is None or hierarchy.rules is not PEAK_RULES:
+        hierarchy = HierarchicalRules(PEAK_RULES, HIERARCHY_GROUPS)
+    return hierarchy
+
 
 def check_PP(maxima):
-    p1, p2, p3 = False, False, 0
-    for index, value in maxima.items():
-        if (index > 1340 and index < 1400):
-            if (value < 0.25 and value > 0.05): p1 = True
-        if (index > 1420 and index < 1480):
-            if (value < 0.2 and value > 0.05): p2 = True
-        if (index > 2800 and index < 3000):
-            if (value < 0.3 and value > 0.08): p3 += 1
-
-    return p1 and p2 and (p3 >= 2)
-    
+    return PEAK_RULES.match(Plastic.PP, maxima)
+
 
 def check_PS(maxima):
-    p1, p2, p3, p4, p5 = 0, 0, 0, 0, 0
-    for index, value in maxima.items():
-        if (index > 1430 and index < 1470): p1 = 1
-        if (index > 1470 and index < 1510): p2 = 1
-        if (index > 1580 and index < 1620): p3 = 1
-        if (index > 2900 and index < 2940): p4 = 1
-        if (index > 3000 and index < 3050): p5 = 1
-    
-    return p1 + p2 + p3 + p4 + p5 >= 4
+    return PEAK_RULES.match(Plastic.PS, maxima)
 
 
 def check_PC(maxima):
-    p1, p2, p3 = False, False, False
-    for index, value in maxima.items():
-        if (value > 0.08 and value < 0.5):
-            if (index > 1240 and index < 1260): p1 = True
-            if (index > 1480 and index < 1520): p2 = True
-            if (index > 1750 and index < 1790): p3 = True
-
-    return p1 and p2 and p3
+    return PEAK_RULES.match(Plastic.PC, maxima)
 
 
 def check_PU(maxima):
-    p1, p2, p3, p4 = False, False, False, False
-    for index, value in maxima.items():
-        if (value > 0.08 and value < 0.6):
-            if (index > 1240 and index < 1280): p1 = True
-            if (index > 1520 and index < 1550): p2 = True
-            if (index > 1700 and index < 1750): p3 = True
-        if (index > 2800 and index < 3000): p4 = True 
-            
-    return p1 and p2 and p3 and p4
+    return PEAK_RULES.match(Plastic.PU, maxima)
 
 
 def check_HDPE(maxima):
-    p1, p2 = False, False
-    for index, value in maxima.items():
-        if (index > 1450 and index < 1480):
-            p1 = True
-        if (index > 2850 and index < 2950):
-            if (value > 0.45): p2 = True
-
-    return p1 and p2
+    return PEAK_RULES.match(Plastic.HDPE, maxima)
 
 
 def check_LDPE(maxima):
-    for index, value in maxima.items():
-        if (index > 2850 and index < 2950):
-            if (value < 0.45 and value > 0.22):
-                return True
-
-    return False
+    return PEAK_RULES.match(Plastic.LDPE, maxima)
 
 
 def check_PET(maxima):
-    p1, p2 = False, False
-    for index, value in maxima.items():
-        if (index > 1230 and index < 1270):
-            if (value > 0.05): p1 = True
-        if (index > 1700 and index < 1740):
-            if (value > 0.05): p2 = True
-
-    return p1 and p2
+    return PEAK_RULES.match(Plastic.PET, maxima)
 
 
 def check_Polyester(maxima):
-    p1, p2 = False, False
-    for index, value in maxima.items():
-        if (value > 0.1):
-            if (index > 1690 and index < 1740): p1 = True
-        if (index > 2700 and index < 3000): p2 = True
+    return PEAK_RULES.match(Plastic.Polyester, maxima)
 
-    return p1 and p2
 
 def check_PVC(maxima):
-    match = 0
-    ind2, ind3, ind4 = 0, 0, 0
-    for index, value in maxima.items():
-        if (index > 1350 and index <= 1500):
-            if (value > ind2):
-                ind2 = value
-        if (index > 1500 and index <= 2000):
-            if (value > ind3):
-                ind3 = value
-        if (index > 2850 and index <= 3000):
-            if (value > ind4):
-                ind4 = value
-
-    if (ind2 > ind3 and ind2 > ind4):
-        if(ind2 <= 0.1):
-            match = 1
-
-    return match
+    return PEAK_RULES.match(Plastic.PVC, maxima)
 
 
-def user_sorting_function(sensors_output):
-    spectrum = sensors_output[1]['spectrum']
+# The analysis runs on contiguous float32 copies of the readings: half the memory
+# and bandwidth of the float64 pandas.Series rcplant delivers, and the same maxima.
+SPECTRUM_DTYPE = np.float32
 
-    # check for zero and shortcircuit
-    if (spectrum.iloc[0] < 0.001 or spectrum.values.mean() < 0.005):
-        return { 1: Plastic.Blank }
 
-    # Generate a line of best fit for the spectrum
-    # Ignore the first 30 points because there is a starting spike
-    z = np.polyfit(spectrum.keys().values[:-30], spectrum.values[:-30], 5)
-    p = np.poly1d(z)
+class AxisContext:
+    # Everything that only depends on the wavenumber axis of a sensor, computed once
+    # and reused for every reading on that axis
+
+    def __init__(self, index, baseline_degree=5, baseline_skip=30):
+        self.index = index
+        self.wavenumbers = np.asarray(index, dtype=float)
+
+        # Vandermonde matrix of the (centered and scaled) axis and the least squares
+        # pseudo-inverse of its fitted part, so the line of best fit of a spectrum is
+        # one matrix-vector product. The first 30 points are skipped because there is
+        # a starting spike.
+        scaled = (self.wavenumbers - self.wavenumbers.mean()) / self.wavenumbers.std()
+        self.vandermonde = np.vander(scaled, baseline_degree + 1)
+        self.baseline_skip = baseline_skip
+        self.baseline_fit = np.linalg.pinv(self.vandermonde[:-baseline_skip]).astype(SPECTRUM_DTYPE)
+
+        # Maxima after 3250 or between 2000 and 2700 are never used, the trendline
+        # rule only applies after 1270
+        self.excluded = (self.wavenumbers > 3250) | ((self.wavenumbers > 2000) & (self.wavenumbers < 2700))
+        self.trendline_checked = self.wavenumbers > 1270
+
+        self._rule_windows = {}
+        self._rule_lists = {}
+        self._ranges = {}
+
+    def compact(self, values):
+        # The analysis representation of the intensities of a reading on this axis
+        return np.ascontiguousarray(values, dtype=SPECTRUM_DTYPE)
+
+    def baseline_coefficients(self, values):
+        # values can be one spectrum or a (num_spectra, num_wavenumbers) matrix
+        return values[..., :-self.baseline_skip] @ self.baseline_fit.T
+
+    def baseline(self, coefficients, positions=slice(None)):
+        return self.vandermonde[positions] @ coefficients
+
+    def windows_at(self, rules, positions):
+        # The band and window membership of the maxima at positions for rules
+        if rules not in self._rule_windows:
+            self._rule_windows[rules] = rules.windows(self.wavenumbers)
+        in_bands, in_windows = self._rule_windows[rules]
+        return in_bands[:, positions], in_windows[:, positions]
+
+    def rule_lists(self, rules):
+        # For every axis position the rows of the bands and of the dominant rule windows
+        # of rules it falls in, as lists for PeakRules.classify_at
+        if rules not in self._rule_lists:
+            in_bands, in_windows = rules.windows(self.wavenumbers)
+            self._rule_lists[rules] = (
+                [np.flatnonzero(column).tolist() for column in in_bands.T],
+                [np.flatnonzero(column).tolist() for column in in_windows.T],
+            )
+        return self._rule_lists[rules]
+
+    def argmax_between(self, values, low, high):
+        # Wavenumber of the largest value with low <= wavenumber <= high, like
+        # spectrum.loc[high:low].idxmax() on the descending axis
+        if (low, high) not in self._ranges:
+            inside = np.flatnonzero((self.wavenumbers >= low) & (self.wavenumbers <= high))
+            self._ranges[low, high] = slice(inside[0], inside[-1] + 1)
+        window = self._ranges[low, high]
+        return self.wavenumbers[window][values[window].argmax()]
+
+
+_axis_contexts = {}
+_last_axis_context = None
+
+
+def get_axis_context(index):
+    # The FTIR sensor reports the same axis for every reading, so this is normally
+    # an identity check against the last context
+    global _last_axis_context
+    if _last_axis_context is not None and _last_axis_context.index is index:
+        return _last_axis_context
+
+    key = np.asarray(index, dtype=float).tobytes()
+    if key not in _axis_contexts:
+        _axis_contexts[key] = AxisContext(index)
+    _last_axis_context = _axis_contexts[key]
+    return _last_axis_context
+
+
+def sliding_max(values, window, pad=0):
+    # Maximum of every `window` consecutive points of a spectrum, which is first
+    # extended by `pad` copies of its edge values on both sides. Running maxima inside
+    # blocks of `window` points from the left and from the right (van Herk /
+    # Gil-Werman): every window spans at most two blocks, so it is two passes whatever
+    # the window. Returns len(values) + 2 * pad - window + 1 values.
+    num_points = len(values) + 2 * pad
+    num_blocks = -(-num_points // window)
+    # the points past the extended spectrum only ever end up in windows past its end
+    extended = np.empty(num_blocks * window, dtype=values.dtype)
+    extended[:pad] = values[0]
+    extended[pad:pad + len(values)] = values
+    extended[pad + len(values):] = values[-1]
+    blocks = extended.reshape(num_blocks, window)
+    from_left = np.maximum.accumulate(blocks, axis=1).ravel()
+    from_right = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.maximum(from_right[:num_points - window + 1], from_left[window - 1:num_points])
+
+
+def local_maxima(spectra, order=10):
+    # Mask of the points greater than the `order` points on each side, along the last
+    # axis of one spectrum or a matrix of spectra. Same as scipy's argrelextrema with
+    # np.greater: it clips at the edges, which is the same as padding with the edge
+    # values, so the first and last points are never maxima.
+    num_points = spectra.shape[-1]
+    if spectra.ndim == 1:
+        # neighbours[i] is the largest of the `order` points before point i - order + 1
+        neighbours = sliding_max(spectra, order, pad=order)
+        return (spectra > neighbours[:num_points]) & (spectra > neighbours[order + 1:order + 1 + num_points])
+
+    # For a matrix 2 * order shifted comparisons stream through memory faster than
+    # the block maxima
+    padding = [(0, 0)] * (spectra.ndim - 1) + [(order, order)]
+    padded = np.pad(spectra, padding, mode='edge')
+    is_max = np.ones(spectra.shape, dtype=bool)
+    for shift in range(1, order + 1):
+        is_max &= spectra > padded[..., order + shift:order + shift + num_points]
+        is_max &= spectra > padded[..., order - shift:order - shift + num_points]
+    return is_max
+
 
-    # Get local maxima relative to 10 other points on each side
-    iloc_max_wavenumbers = argrelextrema(spectrum.values, comparator=np.greater, order=10)[0]
-    max_wavenumbers = spectrum.iloc[iloc_max_wavenumbers]
+def detect_peaks(context, values, coefficients, order=10):
+    # The kept maxima of one spectrum as (positions, heights, threshold): local maxima
+    # from the sliding window maximum, the maximum of the last 20 points, and the
+    # 120% of the mean and 2.7 times the baseline filters
+    positions, threshold = select_maxima(context, values, np.flatnonzero(local_maxima(values, order)), coefficients)
+    return positions, values[positions], threshold
 
-    # Add the local maxima of the first 10 points because it is missed in argrelextrema
-    beginning = pd.Series([spectrum.iloc[-20:].max()], index=[spectrum.iloc[-20:].idxmax()])
-    max_wavenumbers = pd.concat([max_wavenumbers, beginning]).drop_duplicates()
+
+def select_maxima(context, values, positions, coefficients):
+    # Keep the informative local maxima of a spectrum, positions are the local_maxima
+    # in axis order. Returns the kept positions and the threshold.
+
+    # Add the maximum of the last 20 points because it is missed in local_maxima,
+    # a value already seen is dropped like pd.Series.drop_duplicates does
+    tail = len(values) - 20 + values[-20:].argmax()
+    positions = np.append(positions, tail)
+    maxima = values[positions]
+    first = np.unique(maxima, return_index=True)[1]
+    if len(first) < len(positions):
+        first.sort()
+        positions, maxima = positions[first], maxima[first]
 
     # Remove every point that is 
     #   after 3250
     #   between 2000 and 2700
     #   less than 120% of the mean
     #   less than 2.7 times of the trendline
-    threshold = max_wavenumbers.values.mean() * 120 / 100
-    for index, value in max_wavenumbers.items():
-        if (
-            index > 3250 or
-            (index > 2000 and index < 2700) or
-            value < threshold or
-            (index > 1270 and value < p(index) * 2.7)
-        ):
-            max_wavenumbers.drop(index, inplace=True)
-
-    # Plot all the information on the spectrum (this is just visualisation)
-    spectrum.plot()
-    max_wavenumbers.plot(title=spectrum.name, label="maxima", style="v", color="red")
-    plt.plot(spectrum.keys().values[:-20], p(spectrum.keys().values[:-20]) * 2.7, color="green")
-    plt.hlines(y=threshold / 120 * 100, xmin=spectrum.keys().values[0], xmax=spectrum.keys().values[-1], label="mean", linestyles='-', color='black')
-    plt.hlines(y=threshold, xmin=spectrum.keys().values[0], xmax=spectrum.keys().values[-1], label="threshold", linestyles='-', color='yellow')
-    plt.legend()
-
-    for index, value in max_wavenumbers.items():
-        print(f"{index} - {value}")
-        plt.text(index, value, f"({index}, {round(value, 3)})")
-
-    plt.show()
-
-    decision = { 1: Plastic.HDPE }
-
-    if check_PS(max_wavenumbers):
-        decision[1] = Plastic.PS
-    elif check_PP(max_wavenumbers):
-        decision[1] = Plastic.PP
-    elif check_PU(max_wavenumbers):
-        decision[1] = Plastic.PU
-    elif check_Polyester(max_wavenumbers):
-        decision[1] = Plastic.Polyester
-    elif check_PVC(max_wavenumbers):
-        decision[1] = Plastic.PVC
-    elif check_PET(max_wavenumbers):
-        decision[1] = Plastic.PET
-    elif check_HDPE(max_wavenumbers):
-        decision[1] = Plastic.HDPE
-    elif check_LDPE(max_wavenumbers):
-        decision[1] = Plastic.LDPE
-    elif check_PC(max_wavenumbers):
-        decision[1] = Plastic.PC
-
-    print(decision[1])
-    print()
-
-    return decision
+    threshold = maxima.mean() * 120 / 100
+    removed = (
+        context.excluded[positions] |
+        (maxima < threshold) |
+        (context.trendline_checked[positions] & (maxima < context.baseline(coefficients, positions) * 2.7))
+    )
+    return positions[~removed], threshold
 
-def main():
 
-    # simulation parameters
-    conveyor_length = 1000  # cm
-    conveyor_width = 100  # cm
-    conveyor_speed = 15  # cm per second
-    num_containers = 100
-    sensing_zone_location_1 = 500  # cm
-    sensors_sampling_frequency = 10  # Hz
-    simulation_mode = 'testing'
+def classify_peaks(spectrum):
+    context = get_axis_context(spectrum.index)
+    values = context.compact(spectrum.values)
+
+    # Generate a line of best fit for the spectrum
+    with stage('baseline_fit'):
+        coefficients = context.baseline_coefficients(values)
+
+    # Get local maxima relative to 10 other points on each side and keep the informative ones
+    with stage('detect_peaks'):
+        positions, heights, threshold = detect_peaks(context, values, coefficients)
+
+    # Evaluate every plastic's peak rules at once, HDPE when nothing matches, or only
+    # the candidates of the dominant band
+    rules = get_hierarchy() if classification_mode == 'hierarchy' else PEAK_RULES
+    with stage('peak_rules'):
+        plastic = rules.classify_at(context, positions, heights)
+
+    if debug_sink is not None:
+        debug_sink(spectrum, spectrum.iloc[positions], context.baseline(coefficients), threshold, plastic)
+
+    return plastic
+
+
+class TemplateMatcher:
+    # Classifies a spectrum by its distance to the average spectrum of every plastic,
+    # all plastics are scored with one matrix product whatever the number of classes.
+    #   'sse'         sum of squared errors
+    #   'cosine'      1 - cosine similarity
+    #   'correlation' 1 - Pearson correlation, ignores offsets such as sensor noise
+    # The confidence is 1 - best distance / second best distance: 0 for a tie and
+    # close to 1 when one plastic is much closer than all others.
+
+    def __init__(self, plastics, templates, metric='correlation'):
+        templates = np.asarray(templates, dtype=float)
+        self.plastics = list(plastics)
+        self.metric = metric
+
+        if metric == 'sse':
+            self._templates = templates
+            self._squared_norms = (templates ** 2).sum(axis=1)
+        elif metric == 'cosine':
+            self._templates = templates / np.linalg.norm(templates, axis=1, keepdims=True)
+        elif metric == 'correlation':
+            centered = templates - templates.mean(axis=1, keepdims=True)
+            self._templates = centered / np.linalg.norm(centered, axis=1, keepdims=True)
+        else:
+            raise ValueError(f'Invalid template metric: {metric},\n'
+                             f"valid options: ['sse', 'cosine', 'correlation']")
+
+    @classmethod
+    def from_library(cls, metric='correlation', spectrum_type=SpectrumType.FTIR):
+        # The average rcplant library spectrum of every plastic
+        table = DATA_SETS[spectrum_type].get()
+        plastics = [plastic for plastic in Plastic if plastic != Plastic.Blank and plastic.value in table.index]
+        templates = [table.loc[[plastic.value]].to_numpy().mean(axis=0) for plastic in plastics]
+        return cls(plastics, templates, metric)
+
+    def distances(self, spectra):
+        # (num_spectra, num_plastics) for a (num_spectra, num_wavenumbers) matrix
+        spectra = np.atleast_2d(spectra)
+        if self.metric == 'sse':
+            return (spectra ** 2).sum(axis=1, keepdims=True) - 2 * spectra @ self._templates.T + self._squared_norms
+        if self.metric == 'correlation':
+            spectra = spectra - spectra.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(spectra, axis=1, keepdims=True)
+        return 1 - (spectra @ self._templates.T) / np.where(norms > 0, norms, 1)
+
+    def match_batch(self, spectra):
+        distances = self.distances(spectra)
+        order = np.argsort(distances, axis=1)[:, :2]
+        best, second = np.take_along_axis(distances, order, axis=1).T
+        confidences = np.where(second > 0, 1 - np.maximum(best, 0) / np.where(second > 0, second, 1), 0)
+        return [self.plastics[i] for i in order[:, 0]], confidences
+
+    def match(self, values):
+        plastics, confidences = self.match_batch(values)
+        return plastics[0], float(confidences[0])
+
+
+# How classify_spectrum decides: 'peaks' (the peak rules), 'hierarchy' (the peak rules
+# of the dominant band's candidates, see HierarchicalRules) or 'templates' (TemplateMatcher)
+classification_mode = 'peaks'
+template_metric = 'correlation'
+_template_matcher = None
 
+
+def get_template_matcher():
+    global _template_matcher
+    if _template_matcher is None or _template_matcher.metric != template_metric:
+        _template_matcher = TemplateMatcher.from_library(template_metric)
+    return _template_matcher
+
+
+class DecisionCache:
+    # Bounded cache of decisions keyed by a fingerprint of the spectrum values, so a
+    # reading that was already analysed costs a hash lookup. With quantum set, values
+    # are rounded to multiples of it first and near identical readings share a key.
+    # classify_spectrum adds classifier_key to the keys, so a decision made with other
+    # rules or in another classification mode is never returned.
+    # eviction is 'lru' (least recently used) or 'fifo' (oldest entry).
+
+    def __init__(self, max_size=1024, quantum=None, eviction='lru'):
+        if eviction not in ('lru', 'fifo'):
+            raise ValueError(f'Invalid eviction: {eviction},\n'
+                             f"valid options: ['lru', 'fifo']")
+        self.max_size = max_size
+        self.quantum = quantum
+        self.eviction = eviction
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fingerprint(self, values):
+        if self.quantum is not None:
+            values = np.rint(values / self.quantum).astype(np.int64)
+        return hashlib.blake2b(values.tobytes(), digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            plastic = self._entries.get(key)
+            if plastic is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self.eviction == 'lru':
+                    self._entries.move_to_end(key)
+            return plastic
+
+    def put(self, key, plastic):
+        with self._lock:
+            self._entries[key] = plastic
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+# Optional DecisionCache for classify_spectrum, None disables it
+decision_cache = None
+
+
+def classifier_key():
+    # What a decision depends on besides the reading: the classification mode and the
+    # rules or the template metric it uses
+    if classification_mode == 'templates':
+        return classification_mode, template_metric
+    rules = get_hierarchy() if classification_mode == 'hierarchy' else PEAK_RULES
+    return classification_mode, rules.fingerprint
+
+# Deadline-aware mode: seconds user_sorting_function has per tick (see sorting_deadline),
+# None always runs the full analysis. Readings that would not finish in time get the
+# dominant peak decision instead.
+deadline_budget = None
+_full_analysis_seconds = 0.0  # recent worst case of the full analysis, decays slowly
+
+
+def classify_dominant(context, values):
+    # Cheap tier: the position of the largest maxima, like the is_* checks of
+    # examples/main_demo_sorting.py without the random guesses
+    peak = context.wavenumbers[values.argmax()]
+    if 1250 < peak < 1275:
+        return Plastic.PVC
+    if 1400 < peak < 1500:
+        return Plastic.PS
+    if 2850 < peak < 2950:
+        # PP has its second max between 1350 and 1450
+        if 1350 < context.argmax_between(values, 1250, 1550) < 1450:
+            return Plastic.PP
+        return Plastic.HDPE
+    if 1700 < peak < 1800 or peak == 1250:
+        if 3300 < context.argmax_between(values, 3050, 3500) < 3400:
+            return Plastic.PU
+        if context.argmax_between(values, 1250, 1700) < 1300:
+            return Plastic.PET
+        if peak == 1250 or peak > 1750:
+            return Plastic.PC
+        return Plastic.PU
+    return PEAK_RULES.default
+
+
+# The background between containers: readings whose first value or mean is below these
+BLANK_FIRST_VALUE = 0.001
+BLANK_MEAN = 0.005
+
+
+def is_blank(values):
+    # check for zero, the background between containers. One spectrum gives a bool, a
+    # (num_spectra, num_wavenumbers) matrix a boolean array with one value per row.
+    if values.ndim == 1:
+        return values[0] < BLANK_FIRST_VALUE or values.mean() < BLANK_MEAN
+    return (values[:, 0] < BLANK_FIRST_VALUE) | (values.mean(axis=1) < BLANK_MEAN)
+
+
+def classify_spectrum(spectrum, deadline=None):
+    # deadline is a time.perf_counter() time the decision is needed by, or None
+    global _full_analysis_seconds
+    values = spectrum.values
+
+    # check for zero and shortcircuit, cheaper than a cache lookup
+    with stage('blank_check'):
+        blank = is_blank(values)
+    if blank:
+        if metrics is not None:
+            metrics.count('blank_readings')
+        return Plastic.Blank
+
+    if decision_cache is not None:
+        with stage('cache_lookup'):
+            key = classifier_key(), decision_cache.fingerprint(values)
+            plastic = decision_cache.get(key)
+        if plastic is not None:
+            if metrics is not None:
+                metrics.count('cached_decisions')
+            return plastic
+
+    if deadline is not None:
+        with stage('dominant_peak'):
+            plastic = classify_dominant(get_axis_context(spectrum.index), values)
+        # not cached, the full analysis may decide differently when there is time
+        if time.perf_counter() + _full_analysis_seconds > deadline:
+            if metrics is not None:
+                metrics.count('deadline_fallbacks')
+            return plastic
+        start = time.perf_counter()
+
+    if metrics is not None:
+        metrics.count('analysed_readings')
+    if classification_mode in ('peaks', 'hierarchy'):
+        plastic = classify_peaks(spectrum)
+    elif classification_mode == 'templates':
+        with stage('template_match'):
+            plastic, _ = get_template_matcher().match(values)
+    else:
+        raise ValueError(f'Invalid classification mode: {classification_mode},\n'
+                         f"valid options: ['peaks', 'hierarchy', 'templates']")
+
+    if deadline is not None:
+        seconds = time.perf_counter() - start
+        _full_analysis_seconds = max(seconds, 0.9 * _full_analysis_seconds + 0.1 * seconds)
+
+    if decision_cache is not None:
+        decision_cache.put(key, plastic)
+
+    return plastic
+
+
+class ReadingFusion:
+    # Several readings of the same container reach the sorting function. They are
+    # kept per sensor in a ring buffer of `window` readings with a running sum, and
+    # the container is classified once, on the mean spectrum, as soon as the template
+    # matcher is confident about the mean (best vs second best template) or after
+    # max_readings readings. A blank reading starts the next container.
+
+    def __init__(self, window=2, max_readings=2, min_confidence=0.2):
+        self.window = window
+        self.max_readings = max_readings
+        self.min_confidence = min_confidence
+        self._buffers = {}  # sensor id -> (ring buffer, running sum)
+        self._counts = {}  # sensor id -> readings of the current container
+        self.readings = 0
+        self.containers = 0
+        self.confident_decisions = 0
+
+    def reset(self, sensor_id):
+        self._counts[sensor_id] = 0
+        if sensor_id in self._buffers:
+            self._buffers[sensor_id][1][:] = 0
+
+    def add(self, sensor_id, values):
+        # Returns the mean of the last `window` readings of the container
+        if sensor_id not in self._buffers or self._buffers[sensor_id][0].shape[1] != len(values):
+            self._buffers[sensor_id] = (np.zeros((self.window, len(values)), dtype=SPECTRUM_DTYPE), np.zeros(len(values)))
+            self.reset(sensor_id)
+        ring, total = self._buffers[sensor_id]
+        count = self._counts[sensor_id]
+        slot = count % self.window
+        if count >= self.window:
+            total -= ring[slot]
+        ring[slot] = values
+        total += ring[slot]
+        self._counts[sensor_id] = count + 1
+        return total / min(count + 1, self.window)
+
+    def update(self, sensors_output):
+        # The outputs to classify now, with the mean spectrum of their container
+        ready = {}
+        for sensor_id, output in sensors_output.items():
+            spectrum = output['spectrum']
+            if output['type'] != SpectrumType.FTIR or is_blank(spectrum.values):
+                self.reset(sensor_id)
+                continue
+
+            self.readings += 1
+            fused = self.add(sensor_id, spectrum.values)
+            with stage('fusion_confidence'):
+                _, confidence = get_template_matcher().match(fused)
+            if confidence >= self.min_confidence or self._counts[sensor_id] >= self.max_readings:
+                ready[sensor_id] = dict(output, spectrum=pd.Series(fused, index=spectrum.index, name=spectrum.name))
+                self.containers += 1
+                self.confident_decisions += confidence >= self.min_confidence
+                self.reset(sensor_id)
+        return ready
+
+    def stats(self):
+        return {
+            'readings': self.readings,
+            'containers': self.containers,
+            'confident_decisions': self.confident_decisions,
+            'readings_per_decision': self.readings / self.containers if self.containers else 0.0,
+        }
+
+
+# Optional ReadingFusion for user_sorting_function, None classifies every reading
+reading_fusion = None
+
+
+# Worker pool for the sensing zones, created on the first tick with several sensors.
+# Threads share the axis contexts but hold the GIL between NumPy calls, processes
+# run truly in parallel but pickle every spectrum. Processes work on copies of the
+# module globals, so the stage metrics, the decision cache and the debug sink they
+# would record into never reach the main process; they only go with threads.
+sensor_executor = 'thread'  # 'thread' or 'process'
+sensor_workers = None  # None for one worker per sensor
+_sensor_pool = None
+
+
+def get_sensor_pool(num_sensors):
+    global _sensor_pool
+    if _sensor_pool is None:
+        if sensor_executor == 'thread':
+            _sensor_pool = ThreadPoolExecutor(max_workers=sensor_workers or num_sensors, thread_name_prefix='sensor')
+        elif sensor_executor == 'process':
+            recorded = [name for name, value in (('metrics', metrics), ('decision_cache', decision_cache), ('debug_sink', debug_sink))
+                        if value is not None]
+            if recorded:
+                raise ValueError(f"Invalid sensor executor with {', '.join(recorded)}: {sensor_executor},\n"
+                                 f"valid options: ['thread']")
+            _sensor_pool = ProcessPoolExecutor(max_workers=sensor_workers or num_sensors)
+        else:
+            raise ValueError(f'Invalid sensor executor: {sensor_executor},\n'
+                             f"valid options: ['thread', 'process']")
+    return _sensor_pool
+
+
+def shutdown_sensor_pool():
+    global _sensor_pool
+    if _sensor_pool is not None:
+        _sensor_pool.shutdown()
+        _sensor_pool = None
+
+
+def classify_sensor_output(output, deadline=None):
+    # The peak rules are for FTIR spectra, other sensors never make a decision
+    if output['type'] != SpectrumType.FTIR:
+        return Plastic.Blank
+    return classify_spectrum(output['spectrum'], deadline)
+
+
+def user_sorting_function(sensors_output):
+    if metrics is None:
+        return classify_sensors(sensors_output)
+    metrics.count('readings', len(sensors_output))
+    with metrics.stage('tick'):
+        return classify_sensors(sensors_output)
+
+
+def classify_sensors(sensors_output):
+    # One decision per sensing zone, the zones are classified in parallel when
+    # there are several of them. With reading fusion the sensors whose container
+    # is not decided yet return Blank.
+    deadline = None if deadline_budget is None else time.perf_counter() + deadline_budget
+    if reading_fusion is not None:
+        decisions = { sensor_id: Plastic.Blank for sensor_id in sensors_output }
+        decisions.update(classify_outputs(reading_fusion.update(sensors_output), deadline))
+        return decisions
+    return classify_outputs(sensors_output, deadline)
+
+
+def classify_outputs(sensors_output, deadline=None):
+    if len(sensors_output) <= 1:
+        return { sensor_id: classify_sensor_output(output, deadline) for sensor_id, output in sensors_output.items() }
+
+    pool = get_sensor_pool(len(sensors_output))
+    futures = { sensor_id: pool.submit(classify_sensor_output, output, deadline) for sensor_id, output in sensors_output.items() }
+    return { sensor_id: future.result() for sensor_id, future in futures.items() }
+
+
+def find_maxima_batch(context, spectra, order=10):
+    # The maxima selection of user_sorting_function for a (num_spectra, num_wavenumbers)
+    # matrix at once. Returns the kept maxima as flat arrays sorted by spectrum row:
+    # (rows, positions, values) and the threshold of every row.
+    num_rows, num_points = spectra.shape
+
+    # Line of best fit for every spectrum
+    coefficients = context.baseline_coefficients(spectra)
+
+    # Local maxima relative to 10 other points on each side
+    rows, positions = np.nonzero(local_maxima(spectra, order))
+
+    # Add the maximum of the last 20 points that local_maxima misses, it goes after
+    # the other maxima of its row like in select_maxima
+    tail_positions = num_points - 20 + spectra[:, -20:].argmax(axis=1)
+    sequence = np.concatenate([positions, np.full(num_rows, num_points)])
+    rows = np.concatenate([rows, np.arange(num_rows)])
+    positions = np.concatenate([positions, tail_positions])
+    values = spectra[rows, positions]
+
+    # drop_duplicates keeps the first maximum of every value in a row
+    by_value = np.lexsort((sequence, values, rows))
+    duplicate = np.zeros(len(by_value), dtype=bool)
+    duplicate[1:] = (rows[by_value][1:] == rows[by_value][:-1]) & (values[by_value][1:] == values[by_value][:-1])
+    unique = np.sort(by_value[~duplicate])
+    # back to row then axis order with the tail maximum last
+    unique = unique[np.lexsort((sequence[unique], rows[unique]))]
+    rows, positions, values = rows[unique], positions[unique], values[unique]
+
+    # Same removal rules as user_sorting_function
+    counts = np.bincount(rows, minlength=num_rows)
+    thresholds = np.bincount(rows, weights=values, minlength=num_rows) / np.maximum(counts, 1) * 120 / 100
+    trendline = np.einsum('ij,ij->i', context.vandermonde[positions], coefficients[rows])
+    removed = (
+        context.excluded[positions] |
+        (values < thresholds[rows]) |
+        (context.trendline_checked[positions] & (values < trendline * 2.7))
+    )
+    keep = ~removed
+    return rows[keep], positions[keep], values[keep], thresholds
+
+
+def classify_batch(wavenumbers, spectra, chunk_size=1024):
+    # Batch version of user_sorting_function for offline replays: classifies every row
+    # of a (num_spectra, num_wavenumbers) matrix sharing one wavenumber axis and returns
+    # a list with one Plastic per row
+    context = get_axis_context(wavenumbers)
+    spectra = np.atleast_2d(context.compact(spectra))
+    decisions = []
+    for start in range(0, len(spectra), chunk_size):
+        chunk = spectra[start:start + chunk_size]
+        chunk_decisions = np.full(len(chunk), Plastic.Blank, dtype=object)
+
+        # check for zero and shortcircuit
+        blank = is_blank(chunk)
+        if not blank.all():
+            rows, positions, values, _ = find_maxima_batch(context, chunk[~blank])
+            windows = context.windows_at(PEAK_RULES, positions)
+            chunk_decisions[~blank] = PEAK_RULES.classify_batch(rows, None, values, np.count_nonzero(~blank), windows)
+        decisions += list(chunk_decisions)
+
+    return decisions
+
+
+def readings_per_container(conveyor_speed, sensors_sampling_frequency):
+    # Readings every container gets: the calls of the sorting function the smallest
+    # container is under a sensor for, less one as the first or last call can fall
+    # just outside it
+    return max(1, int(MIN_CONTAINER_SIZE / conveyor_speed * sensors_sampling_frequency) - 1)
+
+
+def sorting_deadline(conveyor_speed, sensors_sampling_frequency, safety=0.5):
+    # Seconds the sorting function has for one tick: the next reading comes one
+    # sampling period later and the smallest container leaves the sensing zone after
+    # MIN_CONTAINER_SIZE / conveyor_speed, whichever is sooner, with a safety margin
+    # for the simulation itself
+    return safety * min(1 / sensors_sampling_frequency, MIN_CONTAINER_SIZE / conveyor_speed)
+
+
+def plain_function(function):
+    # rcplant only accepts plain functions as sorting functions, any other callable
+    # (a bound method, a functools.partial) is wrapped in one
+    if isinstance(function, types.FunctionType):
+        return function
+
+    def sorting_function(sensors_output):
+        return function(sensors_output)
+
+    return sorting_function
+
+
+def create_simulator(
+        num_containers,
+        sorting_function=user_sorting_function,
+        conveyor_speed=15,
+        sensing_zone_locations=(500,),
+        sensors_sampling_frequency=10,
+        simulation_mode='testing',
+        conveyor_length=1000,
+        conveyor_width=100):
+    # The RPSimulation of main(), every parameter in cm, cm per second or Hz.
+    # sorting_function can be any callable.
     sensors = [
-        Sensor.create(SpectrumType.FTIR, sensing_zone_location_1),
+        Sensor.create(SpectrumType.FTIR, location) for location in sensing_zone_locations
     ]
 
+    # Precompute the axis context of every sensor before the conveyor starts
+    for sensor in sensors:
+        get_axis_context(sensor.read(None, simulation_mode, sensors_sampling_frequency).index)
+
     conveyor = Conveyor.create(conveyor_speed, conveyor_length, conveyor_width)
 
-    simulator = RPSimulation(
-        sorting_function=user_sorting_function,
+    return RPSimulation(
+        sorting_function=plain_function(sorting_function),
         num_containers=num_containers,
         sensors=sensors,
         sampling_frequency=sensors_sampling_frequency,
@@ -214,7 +1158,136 @@ def main():
         mode=simulation_mode
     )
 
-    elapsed_time = simulator.run()
+
+_library_consolidated = False
+
+
+def consolidate_spectra_library():
+    # rcplant keeps its spectra library as one DataFrame block per wavenumber, so every
+    # new container copies ~1200 blocks just to pick its spectrum (~80 ms, most of the
+    # simulation time). A single float block gives the same spectra and the same random
+    # draws about 100x faster.
+    global _library_consolidated
+    if _library_consolidated:
+        return
+    for dataset in DATA_SETS.values():
+        table = dataset.get()
+        dataset._data_table = pd.DataFrame(table.to_numpy(), index=table.index, columns=table.columns)
+    _library_consolidated = True
+
+
+def run_simulator(simulator, seed=None, clock='virtual', on_tick=None):
+    # Runs the simulation like simulator.run() and returns the simulated seconds.
+    # The conveyor and the sensors always advance on the simulation's own clock:
+    #   'virtual'  every tick runs as soon as the previous one is done
+    #   'realtime' every tick waits for its time on the wall clock, like a real line
+    # Both give the same results. The seed is applied after the reset because training
+    # mode reseeds `random` with 1 there, which would give every seed the same containers.
+    # on_tick is called with the simulator after every tick.
+    if clock not in ('virtual', 'realtime'):
+        raise ValueError(f'Invalid simulation clock: {clock},\n'
+                         f"valid options: ['virtual', 'realtime']")
+
+    consolidate_spectra_library()
+    simulator.reset()
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    tick_seconds = 1 / simulator._simulation_frequency_hz
+    start = time.perf_counter()
+    while not simulator._update():
+        if on_tick is not None:
+            on_tick(simulator)
+        if clock == 'realtime':
+            delay = start + simulator._current_iteration * tick_seconds - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    return simulator._current_iteration * tick_seconds
+
+
+def main():
+
+    # simulation parameters
+    conveyor_length = 1000  # cm
+    conveyor_width = 100  # cm
+    conveyor_speed = 15  # cm per second
+    num_containers = 100
+    sensing_zone_locations = [500]  # cm, one FTIR sensor per sensing zone
+    sensors_sampling_frequency = 10  # Hz
+    simulation_mode = 'testing'
+    simulation_clock = 'virtual'  # 'virtual' (as fast as possible) or 'realtime'
+    debug_mode = None  # None, 'show', 'png' or 'dump' (see debug_sinks.py)
+    decision_cache_size = 0  # readings, e.g. 1024 for training runs and capture replays where readings repeat
+    peak_rules_file = None  # JSON rule table from tune_rules.py, None for the built-in rules
+    hierarchy_file = None  # JSON groups from tune_rules.py --hierarchy, classifies coarse to fine
+    deadline_aware = False  # fall back to the dominant peak when a tick would overrun
+    asynchronous_sorting = False  # classify on the sensor pool, decisions come back on later ticks
+    fuse_readings = False  # classify every container once, on the mean of its readings
+    collect_metrics = False  # per-stage timing of the sorting function (see stage_metrics.py)
+    metrics_file = None  # also write the metrics there, .json or Prometheus text (.prom)
+    capture_directory = None  # records every sensors_output there for capture.py replays
+    capture_overwrite = False  # replace a capture already in capture_directory instead of failing
+
+    global debug_sink, decision_cache, deadline_budget, metrics, reading_fusion, PEAK_RULES, classification_mode, hierarchy
+    if peak_rules_file is not None:
+        PEAK_RULES = load_peak_rules(peak_rules_file)
+    if hierarchy_file is not None:
+        hierarchy = load_hierarchy(hierarchy_file, PEAK_RULES)
+        classification_mode = 'hierarchy'
+    if decision_cache_size > 0:
+        decision_cache = DecisionCache(decision_cache_size)
+    if deadline_aware:
+        deadline_budget = sorting_deadline(conveyor_speed, sensors_sampling_frequency)
+    if fuse_readings:
+        max_readings = readings_per_container(conveyor_speed, sensors_sampling_frequency)
+        reading_fusion = ReadingFusion(window=max_readings, max_readings=max_readings)
+    if debug_mode is not None:
+        import debug_sinks
+        debug_sink = debug_sinks.create(debug_mode)
+    if collect_metrics or metrics_file is not None:
+        import stage_metrics
+        metrics = stage_metrics.StageMetrics(tick_budget=1 / sensors_sampling_frequency)
+
+    sorting_function = user_sorting_function
+    pipeline = None
+    if asynchronous_sorting:
+        import decision_pipeline
+        pipeline = decision_pipeline.DecisionPipeline(
+            classify_sensor_output,
+            is_blank,
+            get_sensor_pool(len(sensing_zone_locations)),
+            max_lag=decision_pipeline.max_lag_ticks(conveyor_speed, sensors_sampling_frequency),
+            timeout=sorting_deadline(conveyor_speed, sensors_sampling_frequency),
+            end_after=decision_pipeline.blank_ticks(conveyor_speed, sensors_sampling_frequency))
+        sorting_function = pipeline.step
+
+    capture_writer = None
+    if capture_directory is not None:
+        import capture
+        capture_writer = capture.CaptureWriter(capture_directory, overwrite=capture_overwrite)
+        sorting_function = capture.recording_sorting_function(capture_writer, sorting_function)
+
+    simulator = create_simulator(
+        num_containers,
+        sorting_function=sorting_function,
+        conveyor_speed=conveyor_speed,
+        sensing_zone_locations=sensing_zone_locations,
+        sensors_sampling_frequency=sensors_sampling_frequency,
+        simulation_mode=simulation_mode,
+        conveyor_length=conveyor_length,
+        conveyor_width=conveyor_width
+    )
+
+    start = time.perf_counter()
+    elapsed_time = run_simulator(simulator, clock=simulation_clock)
+    wall_time = time.perf_counter() - start
+    shutdown_sensor_pool()
+
+    if debug_sink is not None:
+        debug_sink.close()
+    if capture_writer is not None:
+        capture_writer.close()
 
     print(f'\nResults for running the simulation in "{simulation_mode}" mode:')
 
@@ -226,6 +1299,20 @@ def main():
     print(f'Total mistyped containers = {simulator.total_mistyped}')
 
     print(f'\n{num_containers} containers are processed in {elapsed_time:.2f} seconds')
+    print(f'Wall clock time {wall_time:.2f} seconds')
+
+    if decision_cache is not None:
+        print(f'Decision cache: {decision_cache.stats()}')
+
+    if pipeline is not None:
+        print(f'Decision pipeline: {pipeline.stats()}')
+    if reading_fusion is not None:
+        print(f'Reading fusion: {reading_fusion.stats()}')
+
+    if metrics is not None:
+        print(f'\nSorting function stages:\n{metrics.format_summary()}')
+        if metrics_file is not None:
+            metrics.export(metrics_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+import argparse
+import importlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import main
+
+# Splits a large number of containers into independent simulation shards that run on
+# all CPU cores, every shard with its own deterministic seed, and merges the results
+# into one report.
+
+
+def load_sorting_function(name):
+    # 'module:function', e.g. 'main:user_sorting_function'
+    module_name, function_name = name.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def shard_seeds(seed, num_shards):
+    return [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(seed).spawn(num_shards)]
+
+
+def shard_sizes(num_containers, num_shards):
+    size, remainder = divmod(num_containers, num_shards)
+    return [size + (shard < remainder) for shard in range(num_shards)]
+
+
+def run_shard(num_containers, seed, sorting_function, parameters):
+    simulator = main.create_simulator(num_containers, load_sorting_function(sorting_function), **parameters)
+    start = time.perf_counter()
+    elapsed_time = main.run_simulator(simulator, seed)
+    main.shutdown_sensor_pool()
+    return {
+        'num_containers': num_containers,
+        'seed': seed,
+        'identification_result': simulator.identification_result,
+        'total_missed': simulator.total_missed,
+        'total_classified': simulator.total_classified,
+        'total_mistyped': simulator.total_mistyped,
+        'simulated_seconds': elapsed_time,
+        'wall_seconds': time.perf_counter() - start,
+    }
+
+
+def merge_shards(shards):
+    report = {
+        'num_containers': 0,
+        'identification_result': {},
+        'total_missed': 0,
+        'total_classified': 0,
+        'total_mistyped': 0,
+        'simulated_seconds': 0,
+        'shards': [],
+    }
+    for shard in shards:
+        report['num_containers'] += shard['num_containers']
+        # container guids are unique across shards
+        report['identification_result'].update(shard['identification_result'])
+        report['total_missed'] += shard['total_missed']
+        report['total_classified'] += shard['total_classified']
+        report['total_mistyped'] += shard['total_mistyped']
+        report['simulated_seconds'] += shard['simulated_seconds']
+        report['shards'].append({key: value for key, value in shard.items() if key != 'identification_result'})
+    return report
+
+
+def run_sharded(
+        num_containers,
+        num_shards=None,
+        workers=None,
+        seed=0,
+        sorting_function='main:user_sorting_function',
+        **parameters):
+    # parameters are passed to main.create_simulator
+    workers = workers or os.cpu_count()
+    num_shards = num_shards or workers
+    sizes = shard_sizes(num_containers, num_shards)
+    seeds = shard_seeds(seed, num_shards)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(run_shard, size, shard_seed, sorting_function, parameters)
+            for size, shard_seed in zip(sizes, seeds) if size > 0
+        ]
+        report = merge_shards([future.result() for future in futures])
+    report['wall_seconds'] = time.perf_counter() - start
+    report['workers'] = workers
+    return report
+
+
+def main_sharded():
+    parser = argparse.ArgumentParser(description='Run a large simulation as parallel shards')
+    parser.add_argument('--containers', type=int, default=10000)
+    parser.add_argument('--shards', type=int, default=None, help='default: one per worker')
+    parser.add_argument('--workers', type=int, default=None, help='default: one per CPU core')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sorting-function', default='main:user_sorting_function', help='module:function')
+    parser.add_argument('--mode', default='testing', choices=['testing', 'training'])
+    parser.add_argument('--speed', type=int, default=15, help='conveyor speed in cm per second')
+    parser.add_argument('--frequency', type=int, default=10, help='sensors sampling frequency in Hz')
+    parser.add_argument('--locations', type=int, nargs='+', default=[500], help='sensing zone locations in cm')
+    args = parser.parse_args()
+
+    report = run_sharded(
+        args.containers,
+        num_shards=args.shards,
+        workers=args.workers,
+        seed=args.seed,
+        sorting_function=args.sorting_function,
+        conveyor_speed=args.speed,
+        sensors_sampling_frequency=args.frequency,
+        sensing_zone_locations=args.locations,
+        simulation_mode=args.mode,
+    )
+
+    print(f'\nResults for running {len(report["shards"])} shards in "{args.mode}" mode on {report["workers"]} workers:')
+    print(f'Total missed containers = {report["total_missed"]}')
+    print(f'Total sorted containers = {report["total_classified"]}')
+    print(f'Total mistyped containers = {report["total_mistyped"]}')
+
+    print(f'\n{report["num_containers"]} containers are processed in {report["simulated_seconds"]:.2f} simulated seconds')
+    print(f'Wall clock time {report["wall_seconds"]:.2f} seconds, {report["num_containers"] / report["wall_seconds"]:.1f} containers per second')
+
+
+if __name__ == '__main__':
+    main_sharded()
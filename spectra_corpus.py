@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import library_cache
+
+with library_cache.cached_excel():
+    from rcplant import Plastic, Sensor, SpectrumType
+    from rcplant._material import DATA_SETS
+
+# Labeled corpora of FTIR readings for offline work (benchmarks, tuning).
+# A corpus file is an .npz with the shared wavenumber axis, one row of intensities
+# per reading and the plastic value of every reading.
+
+
+class _LibraryContainer:
+    # Stands in for an rcplant Container so Sensor.read adds its usual noise to a
+    # library spectrum
+    def __init__(self, spectrum):
+        self.material = self
+        self._spectrum = spectrum
+
+    def spectrum(self, spectrum_type):
+        return self._spectrum
+
+
+def load_library(spectrum_type=SpectrumType.FTIR):
+    # Every spectrum of the rcplant library as (labels, spectra) where spectra is a
+    # list of pandas.Series named by their plastic
+    table = DATA_SETS[spectrum_type].get()
+    labels = [Plastic(name) for name in table.index]
+    spectra = [table.iloc[row].rename(name) for row, name in enumerate(table.index)]
+    return labels, spectra
+
+
+def sensor_readings(readings_per_spectrum=5, sampling_frequency=10, mode='testing', seed=0):
+    # Sensor readings of every library spectrum, including the blank background,
+    # with the noise level of the given sampling frequency
+    np.random.seed(seed)
+    sensor = Sensor(SpectrumType.FTIR, 0, sensor_id=1)
+    labels, spectra = load_library()
+    readings = []
+    for label, spectrum in zip(labels, spectra):
+        for _ in range(readings_per_spectrum):
+            readings.append((label, sensor.read(_LibraryContainer(spectrum), mode, sampling_frequency)))
+    return readings
+
+
+def save_corpus(path, readings):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    np.savez(
+        path,
+        wavenumbers=readings[0][1].index.values,
+        spectra=np.array([spectrum.values for _, spectrum in readings]),
+        labels=np.array([label.value for label, _ in readings]),
+    )
+
+
+def load_corpus_arrays(path):
+    # (wavenumbers, spectra, labels) with spectra a (num_readings, num_wavenumbers)
+    # matrix and labels a list of Plastic
+    corpus = np.load(path)
+    return corpus['wavenumbers'], corpus['spectra'], [Plastic(label) for label in corpus['labels']]
+
+
+def load_corpus(path, readings_per_spectrum=5, sampling_frequency=10, seed=0):
+    # A recorded corpus, recorded first from noisy library readings when the file does
+    # not exist so later runs replay the same spectra. Returns (labels, spectra) like
+    # sensor_readings, the spectra share one index.
+    if not os.path.exists(path):
+        save_corpus(path, sensor_readings(readings_per_spectrum, sampling_frequency, 'testing', seed))
+
+    wavenumbers, spectra, labels = load_corpus_arrays(path)
+    index = pd.Index(wavenumbers)
+    return labels, [pd.Series(values, index=index, name='unknown_plastic') for values in spectra]
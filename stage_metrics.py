@@ -0,0 +1,133 @@
+import bisect
+import json
+import threading
+import time
+
+# Per-stage latency metrics for user_sorting_function in main.py.
+# Every stage keeps a call count, the total and maximum time and a histogram with
+# fixed buckets, so recording costs the same however long the simulation runs.
+# A tick is one call of the sorting function, it is over budget when it takes longer
+# than the sensors sampling period.
+
+BUCKETS_SECONDS = [
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, float('inf'),
+]
+
+
+class _Stage:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS_SECONDS)
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile
+        rank = fraction * self.count
+        seen = 0
+        for upper, count in zip(BUCKETS_SECONDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(upper, self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        self._metrics.record(self._name, time.perf_counter() - self._start)
+
+
+class StageMetrics:
+    def __init__(self, tick_budget=None):
+        self.tick_budget = tick_budget  # seconds, usually 1 / sensors_sampling_frequency
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        # with metrics.stage('baseline_fit'): ...
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _Stage()
+            stage.count += 1
+            stage.total += seconds
+            stage.max = max(stage.max, seconds)
+            stage.buckets[bisect.bisect_left(BUCKETS_SECONDS, seconds)] += 1
+            if name == 'tick' and self.tick_budget is not None and seconds > self.tick_budget:
+                self._counters['ticks_over_budget'] = self._counters.get('ticks_over_budget', 0) + 1
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def summary(self):
+        with self._lock:
+            return {
+                'tick_budget_seconds': self.tick_budget,
+                'stages': {
+                    name: {
+                        'count': stage.count,
+                        'mean_us': stage.total / stage.count * 1e6,
+                        'p50_us': stage.quantile(0.5) * 1e6,
+                        'p99_us': stage.quantile(0.99) * 1e6,
+                        'max_us': stage.max * 1e6,
+                        'total_seconds': stage.total,
+                    }
+                    for name, stage in self._stages.items()
+                },
+                'counters': dict(self._counters),
+            }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"{'stage':<20}{'calls':>10}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>12}"]
+        for name, stage in summary['stages'].items():
+            lines.append(f"{name:<20}{stage['count']:>10}{stage['mean_us']:>10.1f}{stage['p50_us']:>10.1f}"
+                         f"{stage['p99_us']:>10.1f}{stage['max_us']:>12.1f}")
+        for name, value in summary['counters'].items():
+            lines.append(f'{name} = {value}')
+        if self.tick_budget is not None:
+            lines.append(f'tick budget = {self.tick_budget * 1e3:.1f} ms')
+        return '\n'.join(lines)
+
+    def prometheus_text(self, prefix='sorting'):
+        # Prometheus text exposition format, e.g. for the node exporter textfile collector
+        lines = [
+            f'# HELP {prefix}_stage_seconds Time spent in every stage of the sorting function.',
+            f'# TYPE {prefix}_stage_seconds histogram',
+        ]
+        with self._lock:
+            for name, stage in self._stages.items():
+                cumulative = 0
+                for upper, count in zip(BUCKETS_SECONDS, stage.buckets):
+                    cumulative += count
+                    bound = '+Inf' if upper == float('inf') else repr(upper)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage.total!r}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage.count}')
+            for name, value in self._counters.items():
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                lines.append(f'{prefix}_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        # .json for the summary, anything else (.prom) for the Prometheus text format
+        with open(path, 'w') as output:
+            if path.endswith('.json'):
+                json.dump(self.summary(), output, indent=2)
+            else:
+                output.write(self.prometheus_text())
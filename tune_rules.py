@@ -0,0 +1,272 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import main
+import spectra_corpus
+from main import Plastic
+
+# Offline tuning of the peak rule table of main.py on a labeled corpus.
+# The maxima of every reading are extracted once; a candidate rule table is then only
+# a vectorized PeakRules.matches_batch over those cached maxima. Every round tries
+# small changes of every band limit and intensity cutoff in parallel and keeps the
+# one that helps most, until nothing improves.
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tuning_corpus.npz')
+
+WAVENUMBER_STEPS = [-20, -10, -4, -2, 2, 4, 10, 20]
+VALUE_FACTORS = [0.6, 0.8, 0.9, 0.95, 1.05, 1.1, 1.25, 1.5]
+
+BAND_FIELDS = ['low', 'high', 'min_value', 'max_value']
+
+
+class CachedMaxima:
+    # The maxima of a corpus, computed once with the same selection as classify_peaks
+
+    def __init__(self, wavenumbers, spectra, labels):
+        context = main.get_axis_context(wavenumbers)
+        spectra = context.compact(spectra)
+        blank = main.is_blank(spectra)
+
+        self.labels = np.array([label.value for label in labels])
+        self.blank = blank
+        self.num_rows = np.count_nonzero(~blank)
+        self.rows, positions, self.values, _ = main.find_maxima_batch(context, spectra[~blank])
+        self.wavenumbers = context.wavenumbers[positions]
+
+    def predict(self, rules):
+        # Plastic value of every reading, Blank for the blank short-circuit
+        predictions = np.full(len(self.labels), Plastic.Blank.value, dtype=object)
+        plastics = rules.classify_batch(self.rows, self.wavenumbers, self.values, self.num_rows)
+        predictions[~self.blank] = [plastic.value for plastic in plastics]
+        return predictions
+
+
+_maxima = None
+_evaluated = None
+
+
+def _init_worker(maxima, evaluated):
+    global _maxima, _evaluated
+    _maxima, _evaluated = maxima, evaluated
+
+
+def _score(candidate):
+    band_rules, dominant_rules, order = candidate
+    predictions = _maxima.predict(main.PeakRules(band_rules, dominant_rules, order))
+    return np.mean(predictions[_evaluated] == _maxima.labels[_evaluated])
+
+
+def parameters(band_rules, dominant_rules):
+    # Every tunable number: band limits and finite intensity cutoffs, dominant maxima
+    tunable = []
+    for plastic, (_, bands) in band_rules.items():
+        for band_number, band in enumerate(bands):
+            for field_number, field in enumerate(BAND_FIELDS):
+                if np.isfinite(band[field_number]):
+                    tunable.append(('band', plastic, band_number, field_number))
+    for plastic in dominant_rules:
+        tunable.append(('dominant', plastic, None, None))
+    return tunable
+
+
+def variations(band_rules, dominant_rules, parameter):
+    # Copies of the tables with one number changed
+    kind, plastic, band_number, field_number = parameter
+    if kind == 'dominant':
+        band, other_bands, max_value = dominant_rules[plastic]
+        for factor in VALUE_FACTORS:
+            changed = dict(dominant_rules)
+            changed[plastic] = (band, other_bands, max_value * factor)
+            yield band_rules, changed
+
+    else:
+        required, bands = band_rules[plastic]
+        band = list(bands[band_number])
+        if BAND_FIELDS[field_number] in ('low', 'high'):
+            new_values = [band[field_number] + step for step in WAVENUMBER_STEPS]
+        else:
+            new_values = [band[field_number] * factor for factor in VALUE_FACTORS]
+
+        for new_value in new_values:
+            changed_band = list(band)
+            changed_band[field_number] = new_value
+            low, high, min_value, max_value, _ = changed_band
+            if low >= high or min_value >= max_value:
+                continue
+            changed_bands = list(bands)
+            changed_bands[band_number] = tuple(changed_band)
+            changed = dict(band_rules)
+            changed[plastic] = (required, changed_bands)
+            yield changed, dominant_rules
+
+
+def tune(maxima, training, rules=None, rounds=20, workers=None):
+    rules = rules or main.PEAK_RULES
+    band_rules, dominant_rules, order = rules.band_rules, rules.dominant_rules, rules.order
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(maxima, training)) as pool:
+        _init_worker(maxima, training)
+        best_score = _score((band_rules, dominant_rules, order))
+        print(f'start: training accuracy {best_score:.4f}')
+
+        for round_number in range(rounds):
+            candidates = [
+                (changed_bands, changed_dominant, order)
+                for parameter in parameters(band_rules, dominant_rules)
+                for changed_bands, changed_dominant in variations(band_rules, dominant_rules, parameter)
+            ]
+            start = time.perf_counter()
+            scores = list(pool.map(_score, candidates, chunksize=max(1, len(candidates) // (4 * (workers or os.cpu_count())))))
+            best = int(np.argmax(scores))
+            print(f'round {round_number + 1}: {len(candidates)} candidates in {time.perf_counter() - start:.1f} s, '
+                  f'best training accuracy {scores[best]:.4f}')
+            if scores[best] <= best_score:
+                break
+            best_score = scores[best]
+            band_rules, dominant_rules, _ = candidates[best]
+
+    return main.PeakRules(band_rules, dominant_rules, order, rules.default)
+
+
+def learn_hierarchy(maxima, training, rules=None, bands=None, min_share=0.05):
+    # HierarchicalRules for rules: per band of dominant maxima, the plastics with at
+    # least min_share of its training readings are the candidates. Their order is
+    # built greedily, each position takes the candidate that scores best there with
+    # the others after it, then every default is tried (None falls back to rules). A
+    # group is only kept when it is at least as accurate as rules on its training
+    # readings.
+    rules = rules or main.PEAK_RULES
+    bands = bands or [band for band, _, _ in main.HIERARCHY_GROUPS]
+    labels = maxima.labels[~maxima.blank]
+    training = training[~maxima.blank]
+    flat = np.array([plastic.value for plastic in rules.classify_batch(maxima.rows, maxima.wavenumbers, maxima.values, maxima.num_rows)])
+    groups = main.HierarchicalRules(rules, [(band, [], None) for band in bands]).groups_batch(
+        maxima.rows, maxima.wavenumbers, maxima.values, maxima.num_rows)
+
+    learned = []
+    for group, band in enumerate(bands):
+        selected = np.flatnonzero((groups == group) & training)
+        kept = np.isin(maxima.rows, selected)
+        rows = np.searchsorted(selected, maxima.rows[kept])
+        plastics, counts = np.unique(labels[selected], return_counts=True)
+        candidates = [Plastic(plastic) for plastic, count in zip(plastics, counts) if count >= min_share * len(selected)]
+        if not candidates:
+            continue
+        # the order of the candidates only decides which match wins, so they are matched once
+        matched = main.PeakRules(rules.band_rules, rules.dominant_rules, candidates, None).matches_batch(
+            rows, maxima.wavenumbers[kept], maxima.values[kept], len(selected))
+
+        def score(order, default):
+            columns = matched[:, [candidates.index(plastic) for plastic in order]]
+            fallback = flat[selected] if default is None else default.value
+            predictions = np.where(columns.any(axis=1), np.array([plastic.value for plastic in order])[columns.argmax(axis=1)], fallback)
+            return np.mean(predictions == labels[selected])
+
+        order = []
+        while len(order) < len(candidates):
+            remaining = [plastic for plastic in candidates if plastic not in order]
+            order.append(max(remaining, key=lambda plastic: score(order + [plastic] + [other for other in remaining if other != plastic], None)))
+
+        best_score, best = np.mean(flat[selected] == labels[selected]), None
+        for default in [None] + candidates:
+            default_score = score(order, default)
+            if default_score > best_score or best is None and default_score == best_score:
+                best_score, best = default_score, (band, order, default)
+        if best is not None:
+            learned.append(best)
+    return main.HierarchicalRules(rules, learned)
+
+
+def checks_until_match(maxima, rules, selected):
+    # Plastics classify_at checks for every selected row, it stops at the first match
+    kept = np.isin(maxima.rows, selected)
+    matched = rules.matches_batch(
+        np.searchsorted(selected, maxima.rows[kept]), maxima.wavenumbers[kept], maxima.values[kept], len(selected))
+    if len(rules.order) == 0:
+        return np.zeros(len(selected), dtype=int), np.zeros(len(selected), dtype=bool)
+    return np.where(matched.any(axis=1), matched.argmax(axis=1) + 1, len(rules.order)), matched.any(axis=1)
+
+
+def rule_checks(maxima, hierarchical_rules):
+    # Mean number of plastics whose rules run per non blank reading
+    groups = hierarchical_rules.groups_batch(maxima.rows, maxima.wavenumbers, maxima.values, maxima.num_rows)
+    checks = np.zeros(maxima.num_rows, dtype=int)
+    selected = np.flatnonzero(groups == -1)
+    checks[selected] = checks_until_match(maxima, hierarchical_rules.rules, selected)[0]
+    for group, group_rules in enumerate(hierarchical_rules.group_rules):
+        selected = np.flatnonzero(groups == group)
+        checks[selected], matched = checks_until_match(maxima, group_rules, selected)
+        fallback_rules = hierarchical_rules.fallback_rules[group]
+        if fallback_rules is not None:
+            fallback = selected[~matched]
+            checks[fallback] += checks_until_match(maxima, fallback_rules, fallback)[0]
+    return checks.mean()
+
+
+def confusion_matrix(labels, predictions):
+    plastics = [plastic.value for plastic in Plastic]
+    matrix = np.zeros((len(plastics), len(plastics)), dtype=int)
+    for label, prediction in zip(labels, predictions):
+        matrix[plastics.index(label), plastics.index(prediction)] += 1
+    return plastics, matrix
+
+
+def print_confusion_matrix(labels, predictions):
+    plastics, matrix = confusion_matrix(labels, predictions)
+    names = [plastic[:9] for plastic in plastics]
+    print(f"{'actual / identified':<20}" + ''.join(f'{name:>10}' for name in names))
+    for name, row in zip(names, matrix):
+        print(f'{name:<20}' + ''.join(f'{count:>10}' for count in row))
+
+
+def main_tune():
+    parser = argparse.ArgumentParser(description='Tune the peak rule table on a labeled corpus')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='corpus .npz, recorded from library readings if missing')
+    parser.add_argument('--rules', default=None, help='JSON rule table to start from (default: main.PEAK_RULES)')
+    parser.add_argument('--output', default='tuned_rules.json')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None, help='default: one per CPU core')
+    parser.add_argument('--validation', type=float, default=0.25, help='fraction of readings held out')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hierarchy', default=None, help='also learn coarse to fine groups for the tuned rules, written there')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.corpus):
+        spectra_corpus.save_corpus(args.corpus, spectra_corpus.sensor_readings(readings_per_spectrum=20, seed=args.seed))
+    wavenumbers, spectra, labels = spectra_corpus.load_corpus_arrays(args.corpus)
+
+    start = time.perf_counter()
+    maxima = CachedMaxima(wavenumbers, spectra, labels)
+    print(f'{len(labels)} readings, maxima extracted in {time.perf_counter() - start:.2f} s')
+
+    validation = np.random.default_rng(args.seed).random(len(labels)) < args.validation
+    rules = main.load_peak_rules(args.rules) if args.rules else main.PEAK_RULES
+    tuned = tune(maxima, ~validation, rules, args.rounds, args.workers)
+    main.save_peak_rules(args.output, tuned)
+
+    for name, table in (('current', rules), ('tuned', tuned)):
+        predictions = maxima.predict(table)
+        correct = predictions == maxima.labels
+        print(f'\n{name} rules: training accuracy {correct[~validation].mean():.4f}, '
+              f'validation accuracy {correct[validation].mean():.4f}')
+        print_confusion_matrix(maxima.labels[validation], predictions[validation])
+
+    print(f'\nTuned rule table written to {args.output}')
+
+    if args.hierarchy:
+        hierarchical_rules = learn_hierarchy(maxima, ~validation, tuned)
+        main.save_hierarchy(args.hierarchy, hierarchical_rules)
+        for name, table in (('tuned', tuned), ('coarse to fine', hierarchical_rules)):
+            correct = maxima.predict(table) == maxima.labels
+            checks = rule_checks(maxima, table if table is hierarchical_rules else main.HierarchicalRules(tuned, []))
+            print(f'{name} rules: validation accuracy {correct[validation].mean():.4f}, '
+                  f'{checks:.2f} plastics checked per reading')
+        print(f'Coarse to fine groups written to {args.hierarchy}')
+
+
+if __name__ == '__main__':
+    main_tune()